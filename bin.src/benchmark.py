@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008-2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+
+"""Time the post-processing stages of the demo.
+
+Each of export-results, compare and check_astrometry is run as a separate
+process on the output of ``demo.sh`` (and ``demo.sh --small``), and its wall
+clock and CPU time, throughput and peak resident set size are recorded; a
+stage is skipped if the stage whose output it reads failed.  Results are
+appended to a JSON history file, and compared with the previous result for
+the same host, dataset and stage, so that regressions show up across stack
+versions.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Output repository and exported file suffix of each dataset.
+DATASETS = {"small": ("output_small", "_small"),
+            "full": ("output", "")}
+
+STAGES = ("export", "compare", "check_astrometry")
+
+# Stage whose output each stage reads; a stage is skipped if it failed.
+DEPENDENCIES = {"compare": "export"}
+
+# Directory containing the scripts to benchmark.
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def runStage(args, stdout):
+    """Run ``args``, writing its standard output to the file ``stdout``.
+
+    Return the exit status, the wall clock and CPU times in seconds and the
+    peak resident set size in MB of the process.
+
+    The process is waited for with `os.wait4`, whose resource usage is that
+    of this process alone, rather than the accumulated usage (and largest
+    peak) of all the children waited for so far.
+    """
+    start = time.time()
+    with open(stdout, "w") as out:
+        proc = subprocess.Popen(args, stdout=out)
+        pid, waitStatus, usage = os.wait4(proc.pid, 0)
+    elapsed = time.time() - start
+    status = os.WEXITSTATUS(waitStatus) if os.WIFEXITED(waitStatus) else -1
+    # the process was reaped by wait4, so Popen must not wait for it
+    proc.returncode = status
+    # ru_maxrss is in kilobytes on Linux, and in bytes on OS X.
+    scale = 1024**2 if sys.platform == "darwin" else 1024
+    return status, elapsed, usage.ru_utime + usage.ru_stime, usage.ru_maxrss/scale
+
+
+def countRows(filename):
+    """Return the number of data rows of an exported text file."""
+    with open(filename) as f:
+        return sum(1 for line in f if not line.startswith("#"))
+
+
+def countMatches(filename):
+    """Return the number of matches reported in check_astrometry output."""
+    with open(filename) as f:
+        return sum(int(n) for n in re.findall(r"(\d+) matches found", f.read()))
+
+
+def benchmarkDataset(dataset, repeat, workDir):
+    """Benchmark all stages on one dataset.
+
+    Return a list of result dicts, one per stage.
+    """
+    repo, ext = DATASETS[dataset]
+    if not os.path.isdir(repo):
+        print("Skipping dataset %s: could not find repo %r (run demo.sh first)." % (dataset, repo))
+        return []
+    # The exported file is named as demo.sh does, so that compare.py finds
+    # its reference.
+    exported = os.path.join(workDir, "detected-sources%s.txt" % ext)
+    log = os.path.join(workDir, "stage.log")
+    commands = {
+        "export": ([sys.executable, os.path.join(BIN_DIR, "export-results.py"), repo], exported),
+        "compare": ([sys.executable, os.path.join(BIN_DIR, "compare.py"), exported], log),
+        "check_astrometry": ([sys.executable, os.path.join(BIN_DIR, "check_astrometry.py"), repo], log),
+    }
+
+    results = []
+    failed = set()
+    for stage in STAGES:
+        if DEPENDENCIES.get(stage) in failed:
+            print("Skipping stage %s on dataset %s, as stage %s failed." %
+                  (stage, dataset, DEPENDENCIES[stage]))
+            failed.add(stage)
+            continue
+        args, stdout = commands[stage]
+        times = []
+        cpuTimes = []
+        peakRss = 0
+        for i in range(repeat):
+            status, elapsed, cpu, rss = runStage(args, stdout)
+            if status != 0:
+                print("Stage %s failed on dataset %s with status %d." % (stage, dataset, status))
+                failed.add(stage)
+                break
+            times.append(elapsed)
+            cpuTimes.append(cpu)
+            peakRss = max(peakRss, rss)
+        if not times:
+            continue
+        rows = countMatches(stdout) if stage == "check_astrometry" else countRows(exported)
+        seconds = min(times)
+        results.append(dict(dataset=dataset, stage=stage, seconds=seconds, cpuSeconds=min(cpuTimes),
+                            rows=rows, rowsPerSecond=rows/seconds if seconds > 0 else None,
+                            peakRssMb=peakRss))
+    return results
+
+
+def loadHistory(filename):
+    """Return the list of results stored in the JSON file ``filename``."""
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return json.load(f)
+
+
+def main(datasets, repeat, historyFile):
+    """Benchmark ``datasets``, and append the results to ``historyFile``.
+
+    Return True if all stages ran successfully.
+    """
+    history = loadHistory(historyFile)
+    context = dict(timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   host=platform.node(),
+                   platform=platform.platform(),
+                   python=platform.python_version(),
+                   # eups records the setup version of each product in SETUP_<PRODUCT>.
+                   stack=os.environ.get("SETUP_LSST_DISTRIB", "").split(" -f")[0] or None)
+
+    workDir = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        results = []
+        for dataset in datasets:
+            results.extend(benchmarkDataset(dataset, repeat, workDir))
+    finally:
+        shutil.rmtree(workDir)
+
+    rowFormat = "%-6s %-17s %10s %10s %10s %12s %10s %10s"
+    print(rowFormat % ("Data", "Stage", "Time (s)", "CPU (s)", "Rows", "Rows/s", "RSS (MB)", "vs. prev"))
+    for result in results:
+        result.update(context)
+        key = (result["host"], result["dataset"], result["stage"])
+        previous = [h for h in history if (h["host"], h["dataset"], h["stage"]) == key]
+        ratio = "%.2fx" % (result["seconds"]/previous[-1]["seconds"]) if previous else "-"
+        print(rowFormat % (result["dataset"], result["stage"], "%.2f" % result["seconds"],
+                           "%.2f" % result["cpuSeconds"], result["rows"],
+                           "%.0f" % result["rowsPerSecond"] if result["rowsPerSecond"] else "-",
+                           "%.0f" % result["peakRssMb"], ratio))
+
+    history.extend(results)
+    with open(historyFile, "w") as f:
+        json.dump(history, f, indent=2, sort_keys=True)
+    print("Results appended to %s." % (historyFile,))
+    return len(results) == len(datasets)*len(STAGES)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the post-processing stages of the demo.")
+    parser.add_argument('datasets', nargs='*', default=["small", "full"],
+                        help="Datasets to benchmark, among %s (default: all)." % ", ".join(sorted(DATASETS)))
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="Number of runs of each stage; the fastest is recorded (default: %(default)s).")
+    parser.add_argument('--history', default="benchmarks.json",
+                        help="JSON file to which the results are appended (default: %(default)s).")
+    args = parser.parse_args()
+    for dataset in args.datasets:
+        if dataset not in DATASETS:
+            parser.error("Unknown dataset %r." % (dataset,))
+
+    if main(args.datasets, args.repeat, args.history):
+        print("Ok.")
+    else:
+        sys.exit(1)
@@ -23,181 +23,336 @@
 from __future__ import division
 from __future__ import print_function
 
+import argparse
 import os.path
 import sys
 
 import numpy as np
 
-import lsst.daf.persistence as dafPersist
-import lsst.pipe.base as pipeBase
-import lsst.afw.table as afwTable
-import lsst.geom as geom
+import dataids
 
+# The stack (lsst.daf.persistence, lsst.afw, lsst.geom, lsst.pipe.base) is
+# only imported by the functions which use it, so that starting the script,
+# e.g. for --help or a usage error, does not wait for it to load.
 
-def loadAndMatchData(repo, visits, fields, ref, ref_field, camcol, filter):
-    """Load data from specific visit+field pairs.  Match with reference.
+# Flags of the sources rejected from the astrometric comparison.
+FLAGS = ["base_PixelFlags_flag_saturated", "base_PixelFlags_flag_cr", "base_PixelFlags_flag_interpolated",
+         "base_PsfFlux_flag_edge"]
 
-    @param repo  The repository.  This is generally the directory on disk
-                    that contains the repository and mapper.
-    @param visits  'runs' in SDSS nomenclature.  List.
-    @param fields  Field within a camcol.  List.
-    @param ref        The run of the reference image set.  Scalar.
-    @param ref_field  The field of the reference image set.  Scalar.
-    @param camcol   Camera column to use.  List.
-    @param filter   Name of the filter.  Scalar
 
-    Return a pipeBase.Struct with mag, dist, and number of matches.
+def loadCatalogs(butler, dataIds, makeMapper=None):
+    """Load the src catalogs of ``dataIds`` into a single contiguous catalog.
 
-    Notes: {visit, filter, field, camcol} are sufficient to unique specfiy
-      a data ID for the Butler in the obs_sdss camera mapping.
-    """
-
-    flags = ["base_PixelFlags_flag_saturated", "base_PixelFlags_flag_cr", "base_PixelFlags_flag_interpolated",
-             "base_PsfFlux_flag_edge"]
+    The lengths of the catalogs are first read from their FITS headers, so
+    that the combined catalog is allocated once, and each source is copied
+    once, straight into it.
 
-    # setup butler
-    butler = dafPersist.Butler(repo)
+    @param makeMapper  Optional function returning a SchemaMapper for the
+                       schema of the first catalog; the sources are then
+                       copied into the mapper's output schema.
 
-    for indx, c in enumerate(camcol):
-        dataid = {'run': ref, 'filter': filter, 'field': ref_field, 'camcol': c}
-        oldSrc = butler.get('src', dataid, immediate=True)
-        print(len(oldSrc), "sources in camcol :", c)
-        if indx == 0:
-            # retrieve the schema of the source catalog and extend it in order
-            # to add a field to record the camcol number
-            oldSchema = oldSrc.getSchema()
-            mapper = afwTable.SchemaMapper(oldSchema)
-            mapper.addMinimalSchema(oldSchema)
-            mapper.addOutputField(afwTable.Field[np.int32]("camcol", "camcol number"))
-            newSchema = mapper.getOutputSchema()
-
-            # create the new extented source catalog
-            srcRef = afwTable.SourceCatalog(newSchema)
-
-        # create temporary catalog
-        tmpCat = afwTable.SourceCatalog(srcRef.table)
-        tmpCat.extend(oldSrc, mapper=mapper)
+    Return the combined catalog, and the (start, stop) rows of each input.
+    """
+    import lsst.afw.fits as afwFits
+    import lsst.afw.table as afwTable
+
+    total = sum(afwFits.readMetadata(butler.getUri('src', dataid), hdu=1).getScalar('NAXIS2')
+                for dataid in dataIds)
+    cat = None
+    rows = []
+    for dataid in dataIds:
+        src = butler.get('src', dataid, immediate=True)
+        print(len(src), "sources in camcol :", dataid['camcol'])
+        if cat is None:
+            mapper = makeMapper(src.getSchema()) if makeMapper is not None else None
+            cat = afwTable.SourceCatalog(mapper.getOutputSchema() if mapper is not None else src.getSchema())
+            cat.reserve(total)
+        start = len(cat)
+        if mapper is not None:
+            cat.extend(src, mapper=mapper)
+        else:
+            cat.extend(src, deep=True)
+        rows.append((start, len(cat)))
+    # column access requires the records to be contiguous in memory; this
+    # only copies if the headers did not give the right lengths
+    if not cat.isContiguous():
+        cat = cat.copy(deep=True)
+    return cat, rows
+
+
+def makeReferenceMapper(oldSchema):
+    """Return a SchemaMapper adding the 'camcol' and 'psfMag' fields to ``oldSchema``."""
+    import lsst.afw.table as afwTable
+    mapper = afwTable.SchemaMapper(oldSchema)
+    mapper.addMinimalSchema(oldSchema)
+    mapper.addOutputField(afwTable.Field[np.int32]("camcol", "camcol number"))
+    mapper.addOutputField(afwTable.Field[float]("psfMag", "PSF magnitude", "mag"))
+    return mapper
+
+
+def loadReference(butler, ref, ref_field, camcol, filter):
+    """Load the catalog of the reference visit, concatenated over camcols.
+
+    A 'camcol' column records the camcol of each source, and a 'psfMag'
+    column its PSF magnitude computed with the calibration of its camcol.
+    """
+    dataIds = [{'run': ref, 'filter': filter, 'field': ref_field, 'camcol': c} for c in camcol]
+    srcRef, rows = loadCatalogs(butler, dataIds, makeReferenceMapper)
+    for dataid, (start, stop) in zip(dataIds, rows):
         # fill in the camcol information in numpy mode in order to be efficient
-        tmpCat['camcol'][:] = c
-        # append the temporary catalog to the extended source catalog
-        srcRef.extend(tmpCat, deep=False)
+        srcRef['camcol'][start:stop] = dataid['camcol']
+        # compute the magnitudes of the whole camcol at once, with the
+        # calibration of the camcol
+        photoCalib = butler.get("calexp_photoCalib", dataid)
+        srcRef['psfMag'][start:stop] = photoCalib.instFluxToMagnitude(srcRef[start:stop],
+                                                                      'base_PsfFlux')[:, 0]
 
     print(len(srcRef), "Sources in reference visit :", ref)
+    return srcRef
 
-    mag = []
-    dist = []
-    for v, f in zip(visits, fields):
-        if v == ref:
-            continue
-        for indx, c in enumerate(camcol):
-            dataid = {'run': v, 'filter': filter, 'field': f, 'camcol': c}
-            if indx == 0:
-                srcVis = butler.get('src', dataid, immediate=True)
-            else:
-                srcVis.extend(butler.get('src', dataid, immediate=True), False)
-            print(len(srcVis), "sources in camcol : ", c)
-
-        match = afwTable.matchRaDec(srcRef, srcVis, geom.Angle(1, geom.arcseconds))
-        matchNum = len(match)
-        print("Visit :", v, matchNum, "matches found")
-
-        schemaRef = srcRef.getSchema()
-        schemaVis = srcVis.getSchema()
-        extRefKey = schemaRef["base_ClassificationExtendedness_value"].asKey()
-        extVisKey = schemaVis["base_ClassificationExtendedness_value"].asKey()
-        flagKeysRef = []
-        flagKeysVis = []
-        for fl in flags:
-            keyRef = schemaRef[fl].asKey()
-            flagKeysRef.append(keyRef)
-            keyVis = schemaVis[fl].asKey()
-            flagKeysVis.append(keyVis)
-
-        for m in match:
-            mRef = m.first
-            mVis = m.second
-
-            for fl in flagKeysRef:
-                if mRef.get(fl):
-                    continue
-            for fl in flagKeysVis:
-                if mVis.get(fl):
-                    continue
-
-            # cleanup the reference sources in order to keep only decent star-like objects
-            if mRef.get(extRefKey) >= 1.0 or mVis.get(extVisKey) >= 1.0:
-                continue
-
-            ang = geom.radToMas(m.distance)
-
-            # retrieve the camcol corresponding to the reference source
-            camcolRef = mRef.get('camcol')
-            # retrieve the calibration object associated to the camcol
-            did = {'run': ref, 'filter': filter, 'field': ref_field, 'camcol': camcolRef}
-            photoCalib = butler.get("calexp_photoCalib", did)
-            # compute magnitude
-            refMag = photoCalib.instFluxToMagnitude(mRef.get('base_PsfFlux_instFlux'))
-
-            mag.append(refMag)
-            dist.append(ang)
+
+def loadVisit(butler, visit, field, camcol, filter):
+    """Load the catalog of a visit, concatenated over camcols."""
+    dataIds = [{'run': visit, 'filter': filter, 'field': field, 'camcol': c} for c in camcol]
+    srcVis, rows = loadCatalogs(butler, dataIds)
+    return srcVis
+
+
+class AfwMatcher(object):
+    """Match visit catalogs with a reference catalog using afwTable.matchRaDec.
+
+    @param srcRef   The reference catalog.
+    @param radius   Match radius in arcseconds.
+    @param closest  Only match each reference source with the closest visit
+                    source, rather than with all of those within ``radius``.
+    """
+
+    def __init__(self, srcRef, radius=1.0, closest=True):
+        self.srcRef = srcRef
+        self.radius = radius
+        self.closest = closest
+
+    def match(self, srcVis):
+        """Match a visit catalog with the reference catalog.
+
+        Return arrays of the reference rows, the visit rows and the angular
+        distances in radians of the matches.
+        """
+        import lsst.afw.table as afwTable
+        import lsst.geom as geom
+        mc = afwTable.MatchControl()
+        mc.findOnlyClosest = self.closest
+        match = afwTable.matchRaDec(self.srcRef, srcVis, geom.Angle(self.radius, geom.arcseconds), mc)
+        # look up the catalog rows of the matched sources once
+        matches = afwTable.packMatches(match)
+        return (rowsFromIds(self.srcRef, matches['first']), rowsFromIds(srcVis, matches['second']),
+                matches['distance'])
+
+
+class KDTreeMatcher(AfwMatcher):
+    """Match visit catalogs with a reference catalog using a k-d tree.
+
+    The tree of the reference positions on the unit sphere is built once,
+    and reused for every visit, so that matching a visit costs a query per
+    visit source.  The matches are the same as those of `AfwMatcher`,
+    provided no visit source has more than `MAX_NEIGHBORS` reference sources
+    within the match radius.
+    """
+
+    MAX_NEIGHBORS = 8
+
+    def __init__(self, srcRef, radius=1.0, closest=True):
+        AfwMatcher.__init__(self, srcRef, radius=radius, closest=closest)
+        # Defer importing of scipy until we need it.
+        from scipy.spatial import cKDTree
+        self.tree = cKDTree(unitVectors(srcRef))
+
+    def match(self, srcVis):
+        # chord length corresponding to the match radius
+        chord = 2*np.sin(np.deg2rad(self.radius/3600.)/2)
+        k = min(self.MAX_NEIGHBORS, self.tree.n)
+        if len(srcVis) == 0 or k == 0:
+            return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+        chords, refRows = self.tree.query(unitVectors(srcVis), k=k, distance_upper_bound=chord)
+        visRows = np.repeat(np.arange(len(srcVis)), k)
+        chords, refRows = chords.ravel(), refRows.ravel()
+        found = np.isfinite(chords)
+        chords, refRows, visRows = chords[found], refRows[found], visRows[found]
+        if self.closest:
+            # keep the closest visit source of each reference source
+            order = np.lexsort((chords, refRows))
+            first = np.unique(refRows[order], return_index=True)[1]
+            chords, refRows, visRows = chords[order[first]], refRows[order[first]], visRows[order[first]]
+        return refRows, visRows, 2*np.arcsin(chords/2)
+
+
+# Available matching engines.
+MATCHERS = {'afw': AfwMatcher, 'kdtree': KDTreeMatcher}
+
+
+def unitVectors(catalog):
+    """Return the positions of the sources of ``catalog`` as unit vectors."""
+    ra, dec = catalog['coord_ra'], catalog['coord_dec']
+    return np.column_stack((np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)))
+
+
+def matchVisit(matcher, srcVis):
+    """Match a visit catalog with the reference catalog of ``matcher``.
+
+    Return a pipeBase.Struct with mag and dist arrays for the matched stars
+    which pass the cuts, and the number of matches.
+    """
+    import lsst.pipe.base as pipeBase
+    srcRef = matcher.srcRef
+    refRows, visRows, distance = matcher.match(srcVis)
+
+    # work on columns: apply the cuts as boolean masks
+    good = np.ones(len(refRows), dtype=bool)
+    for fl in FLAGS:
+        good &= ~srcRef[fl][refRows]
+        good &= ~srcVis[fl][visRows]
+
+    # cleanup the reference sources in order to keep only decent star-like objects
+    good &= ~(srcRef['base_ClassificationExtendedness_value'][refRows] >= 1.0)
+    good &= ~(srcVis['base_ClassificationExtendedness_value'][visRows] >= 1.0)
 
     return pipeBase.Struct(
-        mag=mag,
-        dist=dist,
-        match=matchNum
+        # magnitude computed with the calibration of the reference camcol
+        mag=srcRef['psfMag'][refRows[good]],
+        # angular distance in milliarcseconds
+        dist=np.rad2deg(distance[good])*3.6e6,
+        match=len(refRows)
     )
 
 
-def plotAstrometry(mag, dist, match, good_mag_limit=19.5):
-    """Plot angular distance between matched sources from different exposures."""
+# Per-process state of the workers of `matchVisitTask`: a butler per
+# repository, and the matchers of the reference catalogs already loaded.
+_butlers = {}
+_matchers = {}
 
-    # Defer importing of matplotlib until we need it.
-    import matplotlib.pylab as plt
-
-    plt.rcParams['axes.linewidth'] = 2
-    plt.rcParams['mathtext.default'] = 'regular'
-
-    fig, ax = plt.subplots(ncols=2, nrows=3, figsize=(18, 22))
-    ax[0][0].hist(dist, bins=80)
-    ax[0][1].scatter(mag, dist, s=10, color='b')
-    ax[0][0].set_xlim([0., 900.])
-    ax[0][0].set_xlabel("Distance in mas", fontsize=20)
-    ax[0][0].tick_params(labelsize=20)
-    ax[0][0].set_title("Median : %.1f mas" % (np.median(dist)), fontsize=20, x=0.6, y=0.88)
-    ax[0][1].set_xlabel("Magnitude", fontsize=20)
-    ax[0][1].set_ylabel("Distance in mas", fontsize=20)
-    ax[0][1].set_ylim([0., 900.])
-    ax[0][1].tick_params(labelsize=20)
-    ax[0][1].set_title("Number of matches : %d" % match, fontsize=20)
-
-    ax[1][0].hist(dist, bins=150)
-    ax[1][0].set_xlim([0., 400.])
-    ax[1][1].scatter(mag, dist, s=10, color='b')
-    ax[1][1].set_ylim([0., 400.])
-    ax[1][0].set_xlabel("Distance in mas", fontsize=20)
-    ax[1][1].set_xlabel("Magnitude", fontsize=20)
-    ax[1][1].set_ylabel("Distance in mas", fontsize=20)
-    ax[1][0].tick_params(labelsize=20)
-    ax[1][1].tick_params(labelsize=20)
 
-    idxs = np.where(np.asarray(mag) < good_mag_limit)
+def matchVisitTask(args, butler=None):
+    """Load one (visit, filter) and match it with the reference.
 
-    ax[2][0].hist(np.asarray(dist)[idxs], bins=100)
-    ax[2][0].set_xlabel("Distance in mas - mag < %.1f" % good_mag_limit, fontsize=20)
-    ax[2][0].set_xlim([0, 200])
-    ax[2][0].set_title("Median (mag < %.1f) : %.1f mas" %
-                       (good_mag_limit, np.median(np.asarray(dist)[idxs])),
-                       fontsize=20, x=0.6, y=0.88)
-    ax[2][1].scatter(np.asarray(mag)[idxs], np.asarray(dist)[idxs], s=10, color='b')
-    ax[2][1].set_xlabel("Magnitude", fontsize=20)
-    ax[2][1].set_ylabel("Distance in mas - mag < %.1f" % good_mag_limit, fontsize=20)
-    ax[2][1].set_ylim([0., 200.])
-    ax[2][0].tick_params(labelsize=20)
-    ax[2][1].tick_params(labelsize=20)
+    This is run by the worker processes of `main`; the butler, the
+    reference catalog and its matcher are only created once per process.
 
-    plt.suptitle("Astrometry Check", fontsize=30)
-    plotPath = os.path.join("astrometry_sdss.png")
-    plt.savefig(plotPath, format="png")
+    @param args    Tuple of (repo, visit, field, ref, ref_field, camcol,
+                   filter, matcher, radius, closest).
+    @param butler  Butler of the repo to read the catalogs with, rather
+                   than that of the process.
+
+    Return a tuple of (filter, visit, mag, dist, number of matches).
+    """
+    repo, visit, field, ref, ref_field, camcol, filter, matcher, radius, closest = args
+    if butler is None:
+        if repo not in _butlers:
+            import lsst.daf.persistence as dafPersist
+            _butlers[repo] = dafPersist.Butler(repo)
+        butler = _butlers[repo]
+    refKey = (repo, ref, ref_field, tuple(camcol), filter, matcher, radius, closest)
+    if refKey not in _matchers:
+        srcRef = loadReference(butler, ref, ref_field, camcol, filter)
+        _matchers[refKey] = MATCHERS[matcher](srcRef, radius=radius, closest=closest)
+    srcVis = loadVisit(butler, visit, field, camcol, filter)
+    struct = matchVisit(_matchers[refKey], srcVis)
+    print("Visit :", visit, "filter :", filter, struct.match, "matches found")
+    return filter, visit, struct.mag, struct.dist, struct.match
+
+
+def rowsFromIds(catalog, ids):
+    """Return the indices of the records of ``catalog`` with the given ids."""
+    catIds = catalog['id']
+    order = np.argsort(catIds)
+    return order[np.searchsorted(catIds, ids, sorter=order)]
+
+
+# Panels of the astrometry plot: the upper limit in mas of the distances
+# shown, the number of bins of their histogram, and whether only the stars
+# brighter than the magnitude limit are shown.
+PLOT_PANELS = ((900., 80, False), (400., 150, False), (200., 100, True))
+
+# Number of matched stars above which the magnitude-distance panels are
+# binned into hexagons rather than drawn as a scatter plot.
+PLOT_MAX_POINTS = 20000
+
+
+def plotAstrometry(mag, dist, match, good_mag_limit=19.5, plotPath="astrometry_sdss.png",
+                   maxPoints=PLOT_MAX_POINTS, dataPath=None):
+    """Plot angular distance between matched sources from different exposures.
+
+    The histograms and the points of each panel are computed once, and the
+    figure is drawn with the Agg backend, without pyplot.  With more than
+    ``maxPoints`` stars in a panel, the magnitude-distance plot is a hexagonal
+    density map rather than a scatter plot.
+
+    Stars with a non-finite magnitude or distance (e.g. from a non-positive
+    PSF flux) are left out of the panels.
+
+    @param dataPath  If given, the data behind the plot (the distances and
+                     magnitudes as float32, and the histogram of each panel)
+                     are also saved to this compressed .npz file.
+
+    Return the figure.
+    """
+
+    # Defer importing of matplotlib until we need it.
+    import matplotlib
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    mag = np.asarray(mag, dtype=float)
+    dist = np.asarray(dist, dtype=float)
+    good = mag < good_mag_limit
+    goodMag, goodDist = mag[good], dist[good]
+    panels = []
+    for maxDist, bins, onlyGood in PLOT_PANELS:
+        pMag, pDist = (goodMag, goodDist) if onlyGood else (mag, dist)
+        counts, edges = np.histogram(pDist[np.isfinite(pDist)], bins=bins)
+        shown = np.isfinite(pMag) & (pDist <= maxDist)
+        panels.append((maxDist, pMag[shown], pDist[shown], counts, edges))
+
+    if dataPath is not None:
+        data = dict(mag=mag.astype(np.float32), dist=dist.astype(np.float32), match=match,
+                    good_mag_limit=good_mag_limit)
+        for i, (maxDist, pMag, pDist, counts, edges) in enumerate(panels):
+            data["counts%d" % i] = counts
+            data["edges%d" % i] = edges
+        np.savez_compressed(dataPath, **data)
+
+    with matplotlib.rc_context({'axes.linewidth': 2, 'mathtext.default': 'regular'}):
+        fig = Figure(figsize=(18, 22))
+        FigureCanvasAgg(fig)
+        ax = [[fig.add_subplot(3, 2, 2*row + col + 1) for col in range(2)] for row in range(3)]
+        finiteMag = mag[np.isfinite(mag)]
+        magRange = (finiteMag.min(), finiteMag.max()) if len(finiteMag) else (0., 1.)
+        for (maxDist, pMag, pDist, counts, edges), (axHist, axMag) in zip(panels, ax):
+            axHist.hist(edges[:-1], bins=edges, weights=counts)
+            axHist.set_xlim([0., maxDist])
+            if len(pMag) > maxPoints:
+                axMag.hexbin(pMag, pDist, gridsize=100, extent=magRange + (0., maxDist), mincnt=1,
+                             bins='log')
+            else:
+                axMag.scatter(pMag, pDist, s=10, color='b')
+            axMag.set_ylim([0., maxDist])
+            axMag.set_xlabel("Magnitude", fontsize=20)
+            axHist.tick_params(labelsize=20)
+            axMag.tick_params(labelsize=20)
+
+        ax[0][0].set_xlabel("Distance in mas", fontsize=20)
+        ax[0][0].set_title("Median : %.1f mas" % (np.median(dist)), fontsize=20, x=0.6, y=0.88)
+        ax[0][1].set_ylabel("Distance in mas", fontsize=20)
+        ax[0][1].set_title("Number of matches : %d" % match, fontsize=20)
+        ax[1][0].set_xlabel("Distance in mas", fontsize=20)
+        ax[1][1].set_ylabel("Distance in mas", fontsize=20)
+        ax[2][0].set_xlabel("Distance in mas - mag < %.1f" % good_mag_limit, fontsize=20)
+        ax[2][0].set_title("Median (mag < %.1f) : %.1f mas" % (good_mag_limit, np.median(goodDist)),
+                           fontsize=20, x=0.6, y=0.88)
+        ax[2][1].set_ylabel("Distance in mas - mag < %.1f" % good_mag_limit, fontsize=20)
+
+        fig.suptitle("Astrometry Check", fontsize=30)
+        fig.savefig(plotPath, format="png")
+    return fig
 
 
 def checkAstrometry(mag, dist, match,
@@ -237,26 +392,74 @@ def checkAstrometry(mag, dist, match,
     return passed, astromScatter
 
 
-def main(repo, runs, fields, ref, ref_field, camcol, filter, plot=False):
-    """Main executable.
-
-    Returns True if the test passed, False otherwise.
-    """
+# Median reference astrometric scatter in mas for each filter, where it
+# differs from the default of `checkAstrometry`.
+MEDIAN_REF = {'i': 105}
 
-    struct = loadAndMatchData(repo, runs, fields, ref, ref_field, camcol, filter)
-    mag = struct.mag
-    dist = struct.dist
-    match = struct.match
 
-    # Limit depends on filter
-    medianRef = 100
-    if filter == 'i':
-        medianRef = 105
+def main(repo, runs, fields, ref, ref_field, camcol, filters, plot=False, jobs=1, medianRefs=None,
+         matcher='afw', radius=1.0, closest=True, plotMaxPoints=PLOT_MAX_POINTS, plotData=False,
+         butler=None):
+    """Main executable.
 
-    passed, astromScatter = checkAstrometry(mag, dist, match, medianRef=medianRef)
-    if plot:
-        plotAstrometry(mag, dist, match)
-    return passed
+    Every (visit, filter) pair is matched against the reference visit in the
+    same filter, using ``jobs`` processes, and the astrometric scatter is
+    checked for each filter.
+
+    @param filters     Names of the filters.  List.
+    @param jobs        Number of processes to use for matching.
+    @param medianRefs  Dict of median reference astrometric scatter in mas
+                       for each filter, overriding `MEDIAN_REF`.
+    @param matcher     Name of the matching engine, in `MATCHERS`.
+    @param radius      Match radius in arcseconds.
+    @param closest     Only keep the closest match of each reference source.
+    @param plotMaxPoints  Number of stars above which the plots are density maps.
+    @param plotData    Also save the data behind each plot to a .npz file.
+    @param butler      Butler of ``repo`` (or an object with the same get
+                       method) to read the catalogs with when matching in
+                       this process; worker processes (``jobs`` > 1) always
+                       create their own.
+
+    Returns True if the test passed for all filters, False otherwise.
+    """
+    refs = dict(MEDIAN_REF)
+    refs.update(medianRefs or {})
+
+    tasks = [(repo, v, f, ref, ref_field, camcol, filter, matcher, radius, closest)
+             for filter in filters for v, f in zip(runs, fields) if v != ref]
+    if jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(matchVisitTask, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [matchVisitTask(task, butler) for task in tasks]
+
+    summary = []
+    for filter in filters:
+        mag = np.concatenate([r[2] for r in results if r[0] == filter] or [np.array([])])
+        dist = np.concatenate([r[3] for r in results if r[0] == filter] or [np.array([])])
+        match = sum(r[4] for r in results if r[0] == filter)
+
+        print("Filter :", filter)
+        medianRef = refs.get(filter, 100)
+        passed, astromScatter = checkAstrometry(mag, dist, match, medianRef=medianRef)
+        summary.append((filter, match, len(dist), astromScatter, medianRef, passed))
+        if plot:
+            plotPath = "astrometry_sdss.png" if len(filters) == 1 else "astrometry_sdss_%s.png" % filter
+            plotAstrometry(mag, dist, match, plotPath=plotPath, maxPoints=plotMaxPoints,
+                           dataPath=os.path.splitext(plotPath)[0] + ".npz" if plotData else None)
+
+    print()
+    rowFormat = "%-6s %8s %8s %14s %14s %6s"
+    print(rowFormat % ("Filter", "Matches", "Stars", "Scatter (mas)", "Limit (mas)", "Status"))
+    for filter, match, nStars, astromScatter, medianRef, passed in summary:
+        print(rowFormat % (filter, match, nStars, "%.1f" % astromScatter, "%.1f" % medianRef,
+                           "ok" if passed else "FAILED"))
+    return all(s[-1] for s in summary)
 
 
 def defaultData(repo):
@@ -275,20 +478,110 @@ def defaultData(repo):
     return runs, fields, ref, ref_field, camcol, filter
 
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("""Usage: check_astrometry repo
-where repo is the path to a repository containing the output of processCcd
-""")
-        sys.exit(1)
+def selectData(repo, patterns, inputdir=None):
+    """Return the runs, fields, camcols and filters of the dataIds matching ``patterns``.
 
-    repo = sys.argv[1]
-    if not os.path.isdir(repo):
-        print("Could not find repo %r" % (repo,))
-        sys.exit(1)
+    The dataIds are those of the registry of ``inputdir`` (by default, the
+    input repository of ``repo``) with a source catalog in ``repo`` (see
+    `summarizeDataIds`).
+    """
+    import lsst.daf.persistence as dafPersist
+    butler = dafPersist.Butler(repo)
+    if inputdir is None:
+        index = dataids.DataIdIndex.fromOutputRepo(butler, repo)
+    else:
+        index = dataids.DataIdIndex(inputdir)
+    index.addDatasets(butler, repo, ["src"])
+    return summarizeDataIds(index.select(patterns, "src"))
 
-    runs, fields, ref, ref_field, camcol, filter = defaultData(repo)
-    passed = main(repo, runs, fields, ref, ref_field, camcol, filter)
+
+def summarizeDataIds(selected):
+    """Return the runs, fields, camcols and filters of the dataIds ``selected``.
+
+    Each (run, field) is listed once, and the filters in the order of the
+    dataIds.
+    """
+    visits = sorted(set((dataId["run"], dataId["field"]) for dataId in selected))
+    camcols = sorted(set(dataId["camcol"] for dataId in selected))
+    filters = []
+    for dataId in selected:
+        if dataId["filter"] not in filters:
+            filters.append(dataId["filter"])
+    return [v for v, f in visits], [f for v, f in visits], camcols, filters
+
+
+def medianRefArg(value):
+    """Parse a FILTER=MAS command-line argument."""
+    try:
+        filter, mas = value.split("=")
+        return filter, float(mas)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%r is not of the form FILTER=MAS" % (value,))
+
+
+if __name__ == "__main__":
+    runs, fields, ref, ref_field, camcol, filter = defaultData(None)
+
+    parser = argparse.ArgumentParser(
+        description="Check the astrometric scatter between the sources of several visits and a "
+        "reference visit.")
+    parser.add_argument('repo', help="Path to a repository containing the output of processCcd.")
+    parser.add_argument('--runs', type=int, nargs='+',
+                        help="Runs to compare with the reference run (default: %s)." % (runs,))
+    parser.add_argument('--fields', type=int, nargs='+',
+                        help="Field of each of the runs (default: %s)." % (fields,))
+    parser.add_argument('--ref', type=int, default=ref, help="Reference run (default: %(default)s).")
+    parser.add_argument('--ref-field', type=int, default=ref_field,
+                        help="Field of the reference run (default: %(default)s).")
+    parser.add_argument('--camcols', type=int, nargs='+',
+                        help="Camcols to concatenate (default: %s)." % (camcol,))
+    parser.add_argument('--filters', nargs='+',
+                        help="Filters to check (default: %s)." % ([filter],))
+    parser.add_argument('--id', action='append', dest='patterns', metavar='PATTERN',
+                        help='Check the runs, fields, camcols and filters of the dataIds of the repo '
+                        'matching a pattern, e.g. "run=4192^6377 filter=g^r"; may be given several times.  '
+                        '--runs, --fields, --camcols and --filters override what is selected.')
+    parser.add_argument('--input', help="Input repository, whose registry lists the dataIds of --id "
+                        "(default: the input repository of repo).")
+    parser.add_argument('--median-ref', type=medianRefArg, action='append', default=[],
+                        metavar="FILTER=MAS", help="Median reference astrometric scatter for a filter.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of processes to use for matching (default: %(default)s).")
+    parser.add_argument('--matcher', choices=sorted(MATCHERS), default='afw',
+                        help="Matching engine: afwTable.matchRaDec, or a k-d tree of the reference "
+                        "sources built once and reused for every visit (default: %(default)s).")
+    parser.add_argument('--match-radius', type=float, default=1.0,
+                        help="Match radius in arcseconds (default: %(default)s).")
+    parser.add_argument('--all-matches', action='store_true',
+                        help="Keep all matches within the radius, not only the closest one.")
+    parser.add_argument('--plot', action='store_true', help="Plot the astrometric scatter.")
+    parser.add_argument('--plot-max-points', type=int, default=PLOT_MAX_POINTS,
+                        help="Number of stars above which the magnitude-distance plots are hexagonal "
+                        "density maps rather than scatter plots (default: %(default)s).")
+    parser.add_argument('--plot-data', action='store_true',
+                        help="Also save the data behind each plot to a compressed .npz file next to it.")
+    args = parser.parse_args()
+    dataids.checkPatterns(parser, args.patterns)
+
+    if not os.path.isdir(args.repo):
+        print("Could not find repo %r" % (args.repo,))
+        sys.exit(1)
+    filters = [filter]
+    if args.patterns:
+        runs, fields, camcol, filters = selectData(args.repo, args.patterns, args.input)
+        if not runs:
+            parser.error("No dataId of %s matches --id." % (args.repo,))
+    args.runs = args.runs or runs
+    args.fields = args.fields or fields
+    args.camcols = args.camcols or camcol
+    args.filters = args.filters or filters
+    if len(args.runs) != len(args.fields):
+        parser.error("--runs and --fields must have the same number of values.")
+
+    passed = main(args.repo, args.runs, args.fields, args.ref, args.ref_field, args.camcols, args.filters,
+                  plot=args.plot, jobs=args.jobs, medianRefs=dict(args.median_ref),
+                  matcher=args.matcher, radius=args.match_radius, closest=not args.all_matches,
+                  plotMaxPoints=args.plot_max_points, plotData=args.plot_data)
     if passed:
         print("Ok.")
     else:
@@ -3,8 +3,12 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import glob
+import io
+import itertools
 import os
 import sys
+import time
 import numpy as np
 
 # Data columns in the output
@@ -46,13 +50,124 @@ DTYPE = np.dtype(
      ])
 
 
+# File extensions of the formats written by export-results.
+FORMATS = (".txt", ".npy", ".parquet")
+
+
+def get_columns(filename):
+    """Return the names of the data columns in ``filename``."""
+    if filename.endswith(".npy"):
+        return list(np.load(filename, mmap_mode='r').dtype.names)
+    elif filename.endswith(".parquet"):
+        # pyarrow is only needed for Parquet files.
+        import pyarrow.parquet as pq
+        return pq.read_schema(filename).names
+    with open(filename, 'r') as f:
+        return f.readline().strip('#').split()
+
+
 def get_array(filename):
+    """Read ``filename`` into a NumPy structured array.
+
+    Binary files (``.npy`` or ``.parquet``, as written by
+    ``export-results --format``) are read directly, memory-mapped where
+    possible; anything else is parsed as text using the types in `DTYPE` and
+    the column names from the header line.  ``filename`` may also be a
+    structured array already in memory (e.g. exported by bin.src/demo.py),
+    which is returned as is.
+    """
+    if isinstance(filename, np.ndarray):
+        return filename
+    if filename.endswith(".npy"):
+        return np.load(filename, mmap_mode='r')
+    elif filename.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        return arrow_to_array(pq.read_table(filename, memory_map=True))
     with open(filename, 'r') as f:
-        array = np.loadtxt(f, dtype=DTYPE)
+        array = np.loadtxt(f, dtype=text_dtype(filename))
     return array
 
 
-def difference(arr1, arr2):
+def text_dtype(filename):
+    """Return the dtype of the rows of text file ``filename``."""
+    names = get_columns(filename)
+    if len(names) != len(DTYPE):
+        raise ValueError("%s has %d columns; expected %d." % (filename, len(names), len(DTYPE)))
+    return np.dtype([(name, DTYPE[i]) for i, name in enumerate(names)])
+
+
+def arrow_to_array(table):
+    """Convert a pyarrow Table or RecordBatch to a NumPy structured array."""
+    columns = [column.to_numpy(zero_copy_only=False) for column in table.columns]
+    array = np.empty(table.num_rows, dtype=[(name, column.dtype)
+                                            for name, column in zip(table.column_names, columns)])
+    for name, column in zip(table.column_names, columns):
+        array[name] = column
+    return array
+
+
+def iter_blocks(filename, blockSize):
+    """Yield the rows of ``filename`` as structured arrays of at most ``blockSize`` rows.
+
+    Only one block is held in memory at a time.
+    """
+    if filename.endswith(".npy"):
+        array = np.load(filename, mmap_mode='r')
+        for start in range(0, len(array), blockSize):
+            yield array[start:start + blockSize]
+    elif filename.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(filename, memory_map=True).iter_batches(batch_size=blockSize):
+            yield arrow_to_array(batch)
+    else:
+        dtype = text_dtype(filename)
+        with open(filename, 'r') as f:
+            while True:
+                lines = list(itertools.islice(f, blockSize))
+                if not lines:
+                    break
+                yield np.loadtxt(lines, dtype=dtype, ndmin=1)
+
+
+def iter_aligned(blocks1, blocks2):
+    """Yield pairs of equal-length blocks from two iterators of blocks.
+
+    The iterators may split their rows differently.  If one of them runs out
+    of rows first, the remaining rows of the other are yielded paired with
+    None.
+    """
+    blocks1, blocks2 = iter(blocks1), iter(blocks2)
+    block1 = block2 = None
+    while True:
+        if block1 is None or len(block1) == 0:
+            block1 = next(blocks1, None)
+        if block2 is None or len(block2) == 0:
+            block2 = next(blocks2, None)
+        if block1 is None or block2 is None:
+            break
+        n = min(len(block1), len(block2))
+        yield block1[:n], block2[:n]
+        block1, block2 = block1[n:], block2[n:]
+    for block in (block1, block2):
+        if block is not None and len(block) > 0:
+            yield (block, None) if block is block1 else (None, block)
+    for block in blocks1:
+        yield block, None
+    for block in blocks2:
+        yield None, block
+
+
+def isFloat(dtype):
+    """Return True if ``dtype`` holds floating point values."""
+    return issubclass(dtype.type, np.floating)
+
+
+def isFlag(dtype):
+    """Return True if ``dtype`` holds flags: booleans, or their text in text files."""
+    return dtype.kind in "bUS"
+
+
+def difference(arr1, arr2, out=None):
     """
     Compute the relative and absolute differences of numpy arrays arr1 & arr2.
 
@@ -61,30 +176,228 @@ def difference(arr1, arr2):
     * R = 0 if n1 and n2 are equal,
     * R = Inf if n2 differs from n1 and at least one of them is zero,
     * R = A/ min(|n1|, |n2|) if n1 and n2 are both non zero and n2 differs from n1.
+
+    If ``out`` is given, it must be a `DifferenceBuffers` at least as long
+    as the inputs; the results are then views into its arrays, and no
+    temporaries are allocated.
     """
-    absDiff = np.abs(arr1 - arr2)
+    if out is None:
+        out = DifferenceBuffers(len(arr1))
+    n = len(arr1)
+    absDiff, relDiff, divisor = out.absDiff[:n], out.relDiff[:n], out.divisor[:n]
+    mask1, mask2, mask3 = out.mask1[:n], out.mask2[:n], out.mask3[:n]
+
+    np.subtract(arr1, arr2, out=absDiff)
+    np.abs(absDiff, out=absDiff)
 
     # If there is a difference between 0 and something else, the result is
     # infinite.
-    absDiff = np.where((absDiff != 0) & ((arr1 == 0) | (arr2 == 0)), np.inf, absDiff)
+    np.equal(arr1, 0, out=mask1)
+    np.equal(arr2, 0, out=mask2)
+    np.logical_or(mask1, mask2, out=mask1)
+    np.not_equal(absDiff, 0, out=mask2)
+    np.logical_and(mask1, mask2, out=mask1)
+    np.copyto(absDiff, np.inf, where=mask1)
 
     # If both inputs are nan, the result is 0.
-    absDiff = np.where(np.isnan(arr1) & np.isnan(arr2), 0, absDiff)
+    np.isnan(arr1, out=mask1)
+    np.isnan(arr2, out=mask2)
+    np.logical_and(mask1, mask2, out=mask3)
+    np.copyto(absDiff, 0, where=mask3)
 
     # If one input is nan, the result is infinite.
-    absDiff = np.where(np.logical_xor(np.isnan(arr1), np.isnan(arr2)), np.inf, absDiff)
+    np.logical_xor(mask1, mask2, out=mask3)
+    np.copyto(absDiff, np.inf, where=mask3)
 
     # Divide by the minimum of the inputs, unless 0 or nan.
     # If the minimum is 0 or nan, then either both inputs are 0/nan (so there's no
     # difference) or one is 0/nan (in which case the absolute difference is
     # already inf).
-    divisor = np.where(np.minimum(arr1, arr2) == 0, 1, np.minimum(arr1, arr2))
-    divisor = np.where(np.isnan(divisor), 1, divisor)
+    np.minimum(arr1, arr2, out=divisor)
+    np.equal(divisor, 0, out=mask1)
+    np.isnan(divisor, out=mask2)
+    np.logical_or(mask1, mask2, out=mask1)
+    np.copyto(divisor, 1, where=mask1)
+    np.abs(divisor, out=divisor)
+
+    np.divide(absDiff, divisor, out=relDiff)
+    return absDiff, relDiff
+
+
+class DifferenceBuffers(object):
+    """Preallocated work arrays for `difference` on up to ``size`` values."""
+
+    def __init__(self, size):
+        self.absDiff = np.empty(size)
+        self.relDiff = np.empty(size)
+        self.divisor = np.empty(size)
+        self.mask1 = np.empty(size, dtype=bool)
+        self.mask2 = np.empty(size, dtype=bool)
+        self.mask3 = np.empty(size, dtype=bool)
+
+
+class ColumnSummary(object):
+    """The failures of one column, accumulated over blocks of rows.
+
+    The number of failures and the maximum absolute and relative differences
+    are kept, together with the ``top`` worst failing rows of a float column
+    (by relative difference) or the first ``top`` mismatched rows of another
+    (flag or integer) column.
+
+    @param name     Name of the column.
+    @param isFloat  Whether the column holds float values.
+    @param top      Number of failing rows to keep.
+    @param isFlag   Whether a column which does not hold float values holds
+                    flags, rather than other values such as ids.
+    """
+
+    def __init__(self, name, isFloat, top, isFlag=True):
+        self.name = name
+        self.isFloat = isFloat
+        self.top = top
+        # what the mismatches of a column of exact values are called
+        self.label = "flags" if isFlag else "values"
+        self.nFailed = 0
+        self.maxAbsDiff = 0.0
+        self.maxRelDiff = 0.0
+        self.rows = np.empty(0, dtype=np.int64)
+        self.values1 = self.values2 = self.absDiff = self.relDiff = None
+
+    def count(self, nRows, partial=False):
+        """Return the number of failures out of ``nRows``, e.g. "3 of 100" or "3 of the first 100"."""
+        return "%d of %s%d" % (self.nFailed, "the first " if partial else "", nRows)
+
+    def add(self, rows, values1, values2, absDiff=None, relDiff=None):
+        """Add the failing ``rows`` of a block, with their values and differences."""
+        if len(rows) == 0:
+            return
+        self.nFailed += len(rows)
+        if self.values1 is None:
+            self.values1, self.values2 = values1[:0], values2[:0]
+            if self.isFloat:
+                self.absDiff, self.relDiff = absDiff[:0], relDiff[:0]
+        self.rows = np.concatenate([self.rows, rows])
+        self.values1 = np.concatenate([self.values1, values1])
+        self.values2 = np.concatenate([self.values2, values2])
+        if self.isFloat:
+            self.maxAbsDiff = max(self.maxAbsDiff, absDiff.max())
+            self.maxRelDiff = max(self.maxRelDiff, relDiff.max())
+            self.absDiff = np.concatenate([self.absDiff, absDiff])
+            self.relDiff = np.concatenate([self.relDiff, relDiff])
+            # a stable sort keeps the earliest of equally bad rows first
+            keep = np.argsort(-self.relDiff, kind='mergesort')[:self.top]
+            self.absDiff, self.relDiff = self.absDiff[keep], self.relDiff[keep]
+        else:
+            keep = slice(0, self.top)
+        self.rows, self.values1, self.values2 = self.rows[keep], self.values1[keep], self.values2[keep]
+
+    def report(self, nRows, tolerance, partial=False):
+        """Print the number of failures and differences, and the rows kept.
+
+        If ``partial``, the comparison stopped early, and only the first
+        ``nRows`` rows were compared.
+        """
+        if self.isFloat:
+            print("Failed (%s values over tolerance %g; maximum absolute difference %g, maximum "
+                  "relative difference %g) in column %s." %
+                  (self.count(nRows, partial), tolerance, self.maxAbsDiff, self.maxRelDiff, self.name))
+        else:
+            print("Failed (%s %s do not match) in column %s." %
+                  (self.count(nRows, partial), self.label, self.name))
+        if self.top == 0:
+            return
+        header = "    %10s %20s %20s" % ("Row", "Value", "Reference")
+        print(header + (" %12s %12s" % ("Abs. diff.", "Rel. diff.") if self.isFloat else ""))
+        for i, row in enumerate(self.rows):
+            if self.isFloat:
+                print("    %10d %20.12g %20.12g %12g %12g" %
+                      (row, self.values1[i], self.values2[i], self.absDiff[i], self.relDiff[i]))
+            else:
+                print("    %10d %20s %20s" % (row, self.values1[i], self.values2[i]))
+
+
+def alignRows(table1, table2, key="id", radius=1.0):
+    """Match the rows of two tables which hold the same sources.
+
+    With ``key`` "id", sources are matched on their ids with a sort-merge
+    join, and ids must be unique in each table.  With ``key`` "coord",
+    sources are matched with the nearest source of the other table within
+    ``radius`` arcseconds (see `matchCoords`).
+
+    Return arrays of the matched rows of ``table1`` and ``table2``, in the
+    order of ``table2``, and of the unmatched rows of each table.
+    """
+    if key == "id":
+        ids1, ids2 = np.asarray(table1["id"]), np.asarray(table2["id"])
+        for ids in (ids1, ids2):
+            if len(np.unique(ids)) != len(ids):
+                raise ValueError("Source ids are not unique; align on coordinates instead.")
+        _, rows1, rows2 = np.intersect1d(ids1, ids2, assume_unique=True, return_indices=True)
+    elif key == "coord":
+        rows1, rows2 = matchCoords(table1, table2, radius)
+    else:
+        raise ValueError("Unknown alignment key: %s" % (key,))
+    order = np.argsort(rows2)
+    rows1, rows2 = rows1[order], rows2[order]
+    return (rows1, rows2, np.setdiff1d(np.arange(len(table1)), rows1),
+            np.setdiff1d(np.arange(len(table2)), rows2))
+
 
-    return absDiff, absDiff/np.abs(divisor)
+def matchCoords(table1, table2, radius, maxNeighbors=4):
+    """Match the sources of ``table2`` with the nearest ones of ``table1`` (see `alignRows`).
+
+    Candidate pairs are the ``maxNeighbors`` nearest sources of ``table1``
+    within ``radius`` of each source of ``table2``.  Pairs are accepted
+    greedily by increasing distance, each source being matched at most once.
+    Sources at the same distance, such as a parent and a child with the same
+    centroid, are paired by id if possible, and in the order of their rows
+    otherwise.
+    """
+    # Defer importing of scipy until we need it.
+    from scipy.spatial import cKDTree
+
+    def unitVectors(table):
+        ra, dec = np.deg2rad(table["coord_ra"]), np.deg2rad(table["coord_dec"])
+        return np.column_stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)])
+
+    k = min(maxNeighbors, len(table1))
+    if k == 0 or len(table2) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    chord = 2*np.sin(np.deg2rad(radius/3600.)/2)
+    chords, rows1 = cKDTree(unitVectors(table1)).query(unitVectors(table2), k=k, distance_upper_bound=chord)
+    rows2 = np.repeat(np.arange(len(table2)), k)
+    chords, rows1 = chords.reshape(-1), rows1.reshape(-1)
+    found = np.isfinite(chords)
+    chords, rows1, rows2 = chords[found], rows1[found], rows2[found]
+    sameId = np.asarray(table1["id"])[rows1] == np.asarray(table2["id"])[rows2]
+    order = np.lexsort((rows2, rows1, ~sameId, chords))
+    chords, rows1, rows2 = chords[order], rows1[order], rows2[order]
+
+    matched1, matched2 = [], []
+    while len(chords) > 0:
+        # accept the pairs which are the closest remaining pair of both their sources
+        first1 = np.zeros(len(chords), dtype=bool)
+        first1[np.unique(rows1, return_index=True)[1]] = True
+        first2 = np.zeros(len(chords), dtype=bool)
+        first2[np.unique(rows2, return_index=True)[1]] = True
+        accepted = first1 & first2
+        matched1.append(rows1[accepted])
+        matched2.append(rows2[accepted])
+        keep = ~(np.isin(rows1, rows1[accepted]) | np.isin(rows2, rows2[accepted]))
+        chords, rows1, rows2 = chords[keep], rows1[keep], rows2[keep]
+    return np.concatenate(matched1 or [[]]).astype(int), np.concatenate(matched2 or [[]]).astype(int)
+
+
+def reportUnmatched(rows, table, description, limit=10):
+    """Print the number and the first ``limit`` ids of the unmatched ``rows`` of ``table``."""
+    if len(rows) == 0:
+        return
+    ids = " ".join(str(i) for i in np.asarray(table["id"])[rows[:limit]])
+    print("%d sources %s (ids %s%s)." % (len(rows), description, ids, " ..." if len(rows) > limit else ""))
 
 
-def compareWithNumPy(filename, reference, tolerance):
+def compareWithNumPy(filename, reference, tolerance, failFast=False, summary=0, align=None,
+                     matchRadius=1.0):
     """
     Compare a generated data file to a reference using NumPy.
 
@@ -96,35 +409,265 @@ def compareWithNumPy(filename, reference, tolerance):
            within ``tolerance``;
     * Flags recorded in the input and the reference are identical.
 
+    The files may be text or binary (see `get_array`), and need not be in
+    the same format.
+
+    Every failing value is printed, unless ``failFast`` or ``summary`` is
+    given, in which case a `ColumnSummary` is printed for each failing
+    column instead.
+
     @param filename  Path to input data file.
     @param reference Path to reference file.
     @param tolerance Tolerance.
+    @param failFast  Stop at the first failing column.
+    @param summary   Number of worst failing rows to print for each failing
+                     column.
+    @param align     If "id" or "coord", compare the rows of the same sources,
+                     matched by `alignRows`, rather than rows at the same
+                     position; sources only in one file fail the
+                     comparison.  Reported rows are those of the input.  Ids
+                     are not compared when aligning on "coord".
+    @param matchRadius  Match radius in arcseconds when aligning on "coord".
     """
-    with open(filename, 'r') as data, open(reference, 'r') as ref:
-        data_columns = data.readline().strip('#').split()
-        ref_columns = ref.readline().strip('#').split()
     table1, table2 = get_array(filename), get_array(reference)
-    if (table1.dtype != table2.dtype) or (data_columns != ref_columns):
+    rows = np.arange(len(table1))
+    aligned = True
+    if align:
+        rows1, rows2, extra, missing = alignRows(table1, table2, align, matchRadius)
+        reportUnmatched(missing, table2, "of the reference are missing from the input")
+        reportUnmatched(extra, table1, "of the input are not in the reference")
+        aligned = len(missing) == 0 and len(extra) == 0
+        table1, table2, rows = table1[rows1], table2[rows2], rows1
+        if failFast and not aligned:
+            return False
+    elif len(table1) != len(table2):
+        print("Files do not contain the same number of rows.")
+        return False
+    names = table1.dtype.names
+    if names != table2.dtype.names or [isFloat(table1.dtype[n]) for n in names] != \
+            [isFloat(table2.dtype[n]) for n in names]:
         print("Files do not contain the same columns.")
         return False
-    valid = True
+    valid = aligned
     for name in table1.dtype.names:
-        dtype, count = table1.dtype.fields[name]
-        if dtype == np.dtype(float):
-            absDiff, relDiff = difference(table1[name], table2[name])
-            for pos in np.where((relDiff > tolerance) & (absDiff > tolerance))[0]:
-                valid = False
-                print("Failed (absolute difference %g, relative difference %g over tolerance %g) "
-                      "in column %s." % (absDiff[pos], relDiff[pos], tolerance, name))
+        if align == "coord" and name == "id":
+            # ids may differ when aligning on coordinates
+            continue
+        if isFloat(table1.dtype[name]):
+            values1 = np.asarray(table1[name], dtype=float)
+            values2 = np.asarray(table2[name], dtype=float)
+            absDiff, relDiff = difference(values1, values2)
+            positions = np.flatnonzero((relDiff > tolerance) & (absDiff > tolerance))
+            if len(positions) == 0:
+                continue
+            valid = False
+            column = ColumnSummary(name, True, summary)
+            column.add(rows[positions], values1[positions], values2[positions], absDiff[positions],
+                       relDiff[positions])
+            if not (failFast or summary):
+                for pos in positions:
+                    print("Failed (absolute difference %g, relative difference %g over tolerance %g) "
+                          "in column %s." % (absDiff[pos], relDiff[pos], tolerance, name))
+        else:
+            # Flags are text in text files and booleans in binary files, so
+            # compare their string representations.
+            values1, values2 = table1[name].astype(str), table2[name].astype(str)
+            positions = np.flatnonzero(values1 != values2)
+            if len(positions) == 0:
+                continue
+            valid = False
+            column = ColumnSummary(name, False, summary, isFlag(table1.dtype[name]))
+            column.add(rows[positions], values1[positions], values2[positions])
+            if not (failFast or summary):
+                print("Failed (%s of %s %s do not match) in column %s." %
+                      (str(len(positions)), str(len(values1)), column.label, name))
+        if failFast or summary:
+            column.report(len(values1), tolerance)
+        if failFast:
+            break
+    return valid
+
+
+def compareStreaming(filename, reference, tolerance, blockSize, failFast=False, summary=0):
+    """
+    Compare a generated data file to a reference, ``blockSize`` rows at a time.
+
+    The criteria are those of `compareWithNumPy`, but only one block of each
+    file and a fixed set of work arrays are held in memory, so that files of
+    any size can be compared.  Rather than every failing value, the number of
+    failures and the worst offender are reported for each failing column,
+    or the `ColumnSummary` of the column if ``summary`` is given.
+
+    @param filename  Path to input data file.
+    @param reference Path to reference file.
+    @param tolerance Tolerance.
+    @param blockSize Number of rows to read and compare at a time.
+    @param failFast  Stop at the first block with a failing column, and only
+                     report that column, with its failures in the rows read
+                     so far.
+    @param summary   Number of worst failing rows to print for each failing
+                     column.
+    """
+    names = get_columns(filename)
+    if names != get_columns(reference):
+        print("Files do not contain the same columns.")
+        return False
+
+    buffers = DifferenceBuffers(blockSize)
+    values1, values2 = np.empty(blockSize), np.empty(blockSize)
+    failed = np.empty(blockSize, dtype=bool)
+    overAbs = np.empty(blockSize, dtype=bool)
+    columns = None
+    floatColumns = None
+    nRows = 0
+    # whether failFast stopped the comparison before the end of the files
+    stopped = False
+    for block1, block2 in iter_aligned(iter_blocks(filename, blockSize), iter_blocks(reference, blockSize)):
+        if block1 is None or block2 is None:
+            print("Files do not contain the same number of rows.")
+            return False
+        if floatColumns is None:
+            floatColumns = [isFloat(block1.dtype[name]) for name in names]
+            if floatColumns != [isFloat(block2.dtype[name]) for name in names]:
+                print("Files do not contain the same columns.")
+                return False
+            columns = [ColumnSummary(name, isFloatColumn, max(summary, 1), isFlag(block1.dtype[name]))
+                       for name, isFloatColumn in zip(names, floatColumns)]
+        n = len(block1)
+        for column in columns:
+            name = column.name
+            if column.isFloat:
+                np.copyto(values1[:n], block1[name])
+                np.copyto(values2[:n], block2[name])
+                absDiff, relDiff = difference(values1[:n], values2[:n], out=buffers)
+                np.greater(relDiff, tolerance, out=failed[:n])
+                np.greater(absDiff, tolerance, out=overAbs[:n])
+                np.logical_and(failed[:n], overAbs[:n], out=failed[:n])
+                positions = np.flatnonzero(failed[:n])
+                column.add(nRows + positions, values1[positions], values2[positions], absDiff[positions],
+                           relDiff[positions])
+            else:
+                flags1, flags2 = block1[name].astype(str), block2[name].astype(str)
+                positions = np.flatnonzero(flags1 != flags2)
+                column.add(nRows + positions, flags1[positions], flags2[positions])
+            if failFast and column.nFailed > 0:
+                columns = [column]
+                break
+        nRows += n
+        if failFast and len(columns) == 1 and columns[0].nFailed > 0:
+            stopped = True
+            break
+
+    valid = True
+    for column in columns or []:
+        if column.nFailed == 0:
+            continue
+        valid = False
+        if summary:
+            column.report(nRows, tolerance, partial=stopped)
+        elif column.isFloat:
+            print("Failed (%s values over tolerance %g; worst at row %d, absolute difference %g, "
+                  "relative difference %g) in column %s." %
+                  (column.count(nRows, stopped), tolerance, column.rows[0], column.absDiff[0],
+                   column.relDiff[0], column.name))
         else:
-            if not np.all(table1[name] == table2[name]):
-                nTotal = len(table1[name])
-                nDiff = len(np.where(table1[name] != table2[name])[0])
-                print("Failed (%s of %s flags do not match) in column %s." % (str(nDiff), str(nTotal), name))
-                valid = False
+            print("Failed (%s %s do not match; first at row %d) in column %s." %
+                  (column.count(nRows, stopped), column.label, column.rows[0], column.name))
     return valid
 
 
+def comparePair(filename, reference, tolerance, blockSize=None, failFast=False, summary=0, align=None,
+                matchRadius=1.0):
+    """Compare ``filename`` with ``reference``, streaming if ``blockSize`` is given.
+
+    Return True if the comparison is successful.
+    """
+    if blockSize:
+        return compareStreaming(filename, reference, tolerance, blockSize, failFast=failFast,
+                                summary=summary)
+    return compareWithNumPy(filename, reference, tolerance, failFast=failFast, summary=summary,
+                            align=align, matchRadius=matchRadius)
+
+
+def compareTask(args):
+    """Compare one pair of files for `compareBatch`, capturing the report.
+
+    @param args  Tuple of (filename, reference, options), where reference
+                 may be None to use `referenceFilename`, and options are
+                 the keyword arguments of `comparePair`.
+
+    Return the filename, the reference, whether the comparison succeeded,
+    its report and its duration in seconds.  An exception raised by the
+    comparison fails the pair, and is given in its report.
+    """
+    filename, reference, options = args
+    stdout = sys.stdout
+    sys.stdout = report = io.StringIO()
+    start = time.time()
+    try:
+        if reference is None:
+            reference = referenceFilename(filename)
+        valid = comparePair(filename, reference, **options)
+    except Exception as e:
+        # any error, e.g. from a malformed or truncated file, only fails this pair
+        print("Error: %s: %s" % (type(e).__name__, e))
+        valid = False
+    finally:
+        sys.stdout = stdout
+    return filename, reference, valid, report.getvalue(), time.time() - start
+
+
+def readManifest(filename):
+    """Return the (filename, reference) pairs listed in the manifest ``filename``.
+
+    Each line holds a file and optionally its reference (None if not
+    given); blank lines and lines starting with "#" are ignored.
+    """
+    pairs = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields) > 2:
+                raise ValueError("Invalid manifest line: %s" % (line.strip(),))
+            pairs.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return pairs
+
+
+def compareBatch(pairs, options, jobs=1):
+    """Compare many (filename, reference) pairs, ``jobs`` at a time, and print a consolidated report.
+
+    Return True if all comparisons are successful.
+    """
+    start = time.time()
+    tasks = [(filename, reference, options) for filename, reference in pairs]
+    if jobs > 1:
+        # Defer importing of multiprocessing until we need it.
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(compareTask, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [compareTask(task) for task in tasks]
+
+    nFailed = 0
+    for filename, reference, valid, report, seconds in results:
+        nFailed += not valid
+        # the report of a pair whose reference was not found lists the paths searched
+        described = "reference %s" % (reference,) if reference else "no reference"
+        print("%-6s %7.2f s  %s (%s)" % ("Ok" if valid else "FAILED", seconds, filename, described))
+        if not valid:
+            for line in report.splitlines():
+                print("    " + line)
+    print("%d of %d comparisons failed in %.2f s with %d jobs." %
+          (nFailed, len(results), time.time() - start, jobs))
+    return nFailed == 0
+
+
 def determineFlavor():
     """
     Return a string representing the 'flavor' of the local system.
@@ -159,27 +702,70 @@ def extantFile(filename):
 def referenceFilename(checkFilename):
     """
     Attempt to guess the filename to compare our input against.
+
+    A reference in the same format as the input is preferred, but any of the
+    formats written by export-results will do.
     """
-    guess = os.path.join(os.path.split(os.path.dirname(__file__))[0], "expected",
-                         determineFlavor(), os.path.basename(checkFilename))
-    if os.path.isfile(guess):
-        return guess
-    else:
-        raise ValueError("Cannot find reference data (looked for %s)." % (guess,))
+    stem, ext = os.path.splitext(os.path.basename(checkFilename))
+    expected = os.path.join(os.path.split(os.path.dirname(__file__))[0], "expected", determineFlavor())
+    guesses = [os.path.join(expected, stem + e) for e in [ext] + [e for e in FORMATS if e != ext]]
+    for guess in guesses:
+        if os.path.isfile(guess):
+            return guess
+    raise ValueError("Cannot find reference data (looked for %s)." % (", ".join(guesses),))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('filename', type=extantFile, help="Input data file.")
+    parser.add_argument('filename', nargs='*', help="Input data file.  With several files (or glob "
+                        "patterns), each is compared with its reference in batch mode.")
     parser.add_argument('--tolerance', default=1e-10, type=float, help="Tolerance for errors. "
                         "The test will fail if both the relative and absolute errors exceed the tolerance.")
     parser.add_argument('--reference', type=extantFile, help="Reference data for comparison.")
+    parser.add_argument('--block-size', type=int, help="Compare the files this many rows at a time, "
+                        "bounding memory use, and report the number of failures and the worst offender "
+                        "for each column rather than every failure.")
+    parser.add_argument('--fail-fast', action='store_true',
+                        help="Stop at the first failing column, only reporting that column.")
+    parser.add_argument('--summary', type=int, default=0, metavar='N',
+                        help="For each failing column, report the number of failures, the maximum "
+                        "absolute and relative differences and the N worst rows, rather than every "
+                        "failure.")
+    parser.add_argument('--align', choices=('id', 'coord'),
+                        help="Compare the rows of the same sources, matched on their ids or on the nearest "
+                        "coordinates, rather than rows at the same position, and report the sources only "
+                        "found in one of the files.")
+    parser.add_argument('--match-radius', type=float, default=1.0,
+                        help="Match radius in arcseconds for --align coord (default: %(default)s).")
+    parser.add_argument('--manifest', help="Batch mode: file listing a file to compare and optionally its "
+                        "reference on each line.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of comparisons run concurrently in batch mode (default: %(default)s).")
     args = parser.parse_args()
+    if args.align and args.block_size:
+        parser.error("--align cannot be used with --block-size.")
+    options = dict(tolerance=args.tolerance, blockSize=args.block_size, failFast=args.fail_fast,
+                   summary=args.summary, align=args.align, matchRadius=args.match_radius)
 
-    if not args.reference:
-        args.reference = referenceFilename(args.filename)
-
-    if compareWithNumPy(args.filename, args.reference, args.tolerance):
+    filenames = []
+    for pattern in args.filename:
+        filenames.extend(sorted(glob.glob(pattern)) or [pattern])
+    if args.manifest or len(filenames) > 1:
+        if args.reference:
+            parser.error("--reference cannot be used in batch mode.")
+        pairs = [(filename, None) for filename in filenames]
+        if args.manifest:
+            pairs.extend(readManifest(args.manifest))
+        valid = compareBatch(pairs, options, jobs=args.jobs)
+    elif len(filenames) == 1:
+        try:
+            filename = extantFile(filenames[0])
+        except argparse.ArgumentTypeError as e:
+            parser.error(str(e))
+        valid = comparePair(filename, args.reference or referenceFilename(filename), **options)
+    else:
+        parser.error("No input file given.")
+    if valid:
         print("Ok.")
     else:
         sys.exit(1)
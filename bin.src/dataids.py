@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""Discover the dataIds of the demo repositories.
+
+The raw frames of the input repository are listed in its registry
+(``registry.sqlite3``).  `DataIdIndex` reads them with a single query, and
+records which of them have a dataset (e.g. "src") in an output repository
+from a single listing of its files, rather than probing each dataId with
+the butler.  export-results.py, check_astrometry.py and demo.sh select
+their dataIds from such an index.
+
+dataIds are selected with patterns in the syntax of the ``--id`` argument
+of the command line tasks, e.g. "run=4192 filter=g^r camcol=4": a value may
+list alternatives separated by "^", be a range of integers "first..last",
+or a glob pattern such as "*".  A dataId is selected if it matches any of
+the patterns.
+
+The input repository of an output repository is found by following its
+parents, as recorded by the butler (a ``_parent`` link, or the parents
+listed in ``repositoryCfg.yaml``), up to the first with a registry.
+
+Run this script to print the selected dataIds of a repository, one per
+line, e.g.::
+
+    $ python bin.src/dataids.py input --id "run=4192 filter=g^i^z"
+    run=4192 filter=g camcol=4 field=300
+    ...
+"""
+from __future__ import print_function
+
+import argparse
+import fnmatch
+import os
+import sqlite3
+
+# Keys of a dataId, in the order in which they are printed.
+KEYS = ("run", "filter", "camcol", "field")
+
+# Order of the SDSS filters, in which dataIds are sorted.
+FILTERS = "ugriz"
+
+
+def sortKey(dataId):
+    """Return the key sorting dataIds by filter, run, field and camcol."""
+    filter = dataId["filter"]
+    return (FILTERS.index(filter) if filter in FILTERS else len(FILTERS), filter,
+            dataId["run"], dataId["field"], dataId["camcol"])
+
+
+def formatDataId(dataId):
+    """Return ``dataId`` as a "key=value ..." string."""
+    return " ".join("%s=%s" % (key, dataId[key]) for key in KEYS)
+
+
+def parsePattern(text):
+    """Parse a "key=value ..." selection pattern into a dict of lists of alternatives."""
+    pattern = {}
+    for item in text.split():
+        key, sep, value = item.partition("=")
+        if not sep or key not in KEYS:
+            raise ValueError("Invalid dataId pattern %r; expected key=value with key in %s." %
+                             (text, ", ".join(KEYS)))
+        pattern[key] = value.split("^")
+    return pattern
+
+
+def checkPatterns(parser, patterns):
+    """Report an invalid pattern of ``patterns`` as a usage error of the argparse ``parser``."""
+    for pattern in patterns or []:
+        try:
+            parsePattern(pattern)
+        except ValueError as e:
+            parser.error(str(e))
+
+
+def matchValue(value, alternative):
+    """Return whether ``value`` matches one alternative of a pattern."""
+    first, sep, last = alternative.partition("..")
+    if sep and isinstance(value, int):
+        return int(first) <= value <= int(last)
+    return fnmatch.fnmatchcase(str(value), alternative)
+
+
+def matches(dataId, pattern):
+    """Return whether ``dataId`` matches the parsed ``pattern``."""
+    return all(any(matchValue(dataId[key], alternative) for alternative in alternatives)
+               for key, alternatives in pattern.items())
+
+
+def parentRepos(repo):
+    """Return the parent repositories of ``repo``, as recorded in it.
+
+    Old style repositories link to their parent with a ``_parent`` symlink;
+    others list their parents, as paths or as the configs of the parents,
+    in ``repositoryCfg.yaml``.
+    """
+    parent = os.path.join(repo, "_parent")
+    if os.path.lexists(parent):
+        return [os.path.realpath(parent)]
+    cfgFile = os.path.join(repo, "repositoryCfg.yaml")
+    if not os.path.exists(cfgFile):
+        return []
+    # PyYAML comes with the stack, which writes repositoryCfg.yaml.
+    import yaml
+
+    class CfgLoader(yaml.SafeLoader):
+        """Load the tagged objects of the butler as plain mappings, sequences and scalars."""
+
+    def construct(loader, suffix, node):
+        if isinstance(node, yaml.MappingNode):
+            return loader.construct_mapping(node, deep=True)
+        if isinstance(node, yaml.SequenceNode):
+            return loader.construct_sequence(node, deep=True)
+        return loader.construct_scalar(node)
+
+    CfgLoader.add_multi_constructor("", construct)
+    with open(cfgFile) as f:
+        cfg = yaml.load(f, Loader=CfgLoader) or {}
+    parents = []
+    for parent in cfg.get("_parents") or []:
+        if isinstance(parent, dict):
+            parent = parent.get("_root")
+        if parent:
+            parent = parent[len("file://"):] if parent.startswith("file://") else parent
+            parents.append(os.path.realpath(os.path.join(repo, parent)))
+    return parents
+
+
+def findInputRepo(repo):
+    """Return ``repo`` or its nearest ancestor with a registry.sqlite3, or None."""
+    pending = [repo]
+    seen = set()
+    while pending:
+        repo = pending.pop(0)
+        if os.path.realpath(repo) in seen:
+            continue
+        seen.add(os.path.realpath(repo))
+        if os.path.exists(os.path.join(repo, "registry.sqlite3")):
+            return repo
+        pending.extend(parentRepos(repo))
+    return None
+
+
+class DataIdIndex(object):
+    """Index of the dataIds of an input repository, and of their datasets.
+
+    @param inputRepo  Input repository, with a registry.sqlite3 listing its
+                      raw frames.
+    @param rows       Tuples of the values of `KEYS` of the dataIds, used
+                      rather than the registry of ``inputRepo`` if given.
+    """
+
+    def __init__(self, inputRepo="input", rows=None):
+        if rows is None:
+            registry = os.path.join(inputRepo, "registry.sqlite3")
+            if not os.path.exists(registry):
+                raise RuntimeError("Could not find the registry %s." % (registry,))
+            connection = sqlite3.connect(registry)
+            try:
+                rows = connection.execute("SELECT DISTINCT run, filter, camcol, field FROM raw").fetchall()
+            finally:
+                connection.close()
+        self.dataIds = sorted((dict(zip(KEYS, row)) for row in rows), key=sortKey)
+        # Per dataset type, the set of the dataIds (as tuples) which have it.
+        self.datasets = {}
+
+    @classmethod
+    def fromOutputRepo(cls, butler, repo):
+        """Return the index of the input repository of the output repository ``repo``.
+
+        The input repository is the nearest ancestor of ``repo`` with a
+        registry (see `findInputRepo`); if there is none, the dataIds of the
+        raw frames are queried from ``butler``, whose output is ``repo``.
+        """
+        inputRepo = findInputRepo(repo)
+        if inputRepo is not None:
+            return cls(inputRepo)
+        return cls(rows=[tuple(row) for row in butler.queryMetadata("raw", list(KEYS))])
+
+    def addDatasets(self, butler, repo, datasetTypes):
+        """Record which dataIds have each of ``datasetTypes`` in the output repository ``repo``.
+
+        ``butler`` must have ``repo`` as its output; the files of the
+        repository are listed once, and compared with the location of each
+        dataset as given by the butler.
+        """
+        root = os.path.realpath(repo)
+        files = set()
+        for dirpath, dirnames, filenames in os.walk(root):
+            files.update(os.path.join(dirpath, f) for f in filenames)
+        for datasetType in datasetTypes:
+            available = self.datasets.setdefault(datasetType, set())
+            for dataId in self.dataIds:
+                uri = butler.getUri(datasetType, dataId, write=True)
+                if os.path.join(root, os.path.relpath(os.path.realpath(uri), root)) in files:
+                    available.add(tuple(dataId[key] for key in KEYS))
+
+    def select(self, patterns=None, datasetType=None):
+        """Return the sorted dataIds matching any of ``patterns`` (all if None or empty).
+
+        If ``datasetType`` is given, only the dataIds which have it (see
+        `addDatasets`) are returned.
+        """
+        parsed = [parsePattern(pattern) for pattern in patterns or []]
+        selected = []
+        for dataId in self.dataIds:
+            if parsed and not any(matches(dataId, pattern) for pattern in parsed):
+                continue
+            if datasetType is not None and \
+                    tuple(dataId[key] for key in KEYS) not in self.datasets.get(datasetType, ()):
+                continue
+            selected.append(dict(dataId))
+        return selected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the dataIds of a repository, one per line.")
+    parser.add_argument('input', help="Input repository.")
+    parser.add_argument('--id', action='append', default=[], dest='patterns', metavar='PATTERN',
+                        help='Select the dataIds matching a pattern, e.g. "run=4192 filter=g^r"; may be '
+                        'given several times (default: all dataIds).')
+    parser.add_argument('--output', help="Output repository in which to look for --dataset.")
+    parser.add_argument('--dataset', help="Only print the dataIds with this dataset in --output.")
+    args = parser.parse_args()
+    if bool(args.output) != bool(args.dataset):
+        parser.error("--output and --dataset must be given together.")
+    checkPatterns(parser, args.patterns)
+
+    index = DataIdIndex(args.input)
+    if args.dataset:
+        # The butler is only needed to locate the datasets.
+        import lsst.daf.persistence as dafPersist
+        index.addDatasets(dafPersist.Butler(args.output), args.output, [args.dataset])
+    for dataId in index.select(args.patterns, args.dataset):
+        print(formatDataId(dataId))
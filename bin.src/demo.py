@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""Run the stages of the demo in a single process.
+
+bin/demo.sh, compare.py and check_astrometry.py each run in a process of
+their own, which imports the stack and constructs a butler again.  Here, the
+stages are subcommands of one script::
+
+    $ python bin.src/demo.py --small all
+
+runs processCcd on the dataIds of the demo (``process``), exports the
+columns of their source catalogs (``export``), compares them with the
+expected results (``compare``) and checks the astrometric scatter
+(``check-astrometry``).  The post-processing stages share a single `Session`:
+one butler of the output repository, which keeps the src catalogs it reads
+in memory, so that each catalog is only read once, and the exported table is
+compared in memory rather than read back from its file.
+"""
+from __future__ import print_function
+
+import argparse
+import importlib.util
+import os
+import sys
+
+import numpy as np
+
+import check_astrometry
+import compare
+import dataids
+
+# Directory of the scripts of the package.
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Patterns of the dataIds processed by the demo, as in bin/demo.sh.
+DATAID_PATTERNS = ["run=4192 camcol=4 field=300", "run=6377 camcol=4 field=399"]
+SMALL_DATAID_PATTERNS = ["run=4192 camcol=4 field=300 filter=g^i^z",
+                         "run=6377 camcol=4 field=399 filter=u^r^i"]
+
+
+def loadScript(name):
+    """Import the script ``name`` of `BIN_DIR`, whose name need not be a valid module name."""
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), os.path.join(BIN_DIR, name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Session(object):
+    """The butler of an output repository, shared by the stages of the demo.
+
+    The src catalogs read through the session are kept in memory, and
+    returned again when they are read by later stages; the stages only read
+    them, copying what they modify.  Everything else is passed on to the
+    butler.
+
+    @param repo  Output repository.
+    """
+
+    def __init__(self, repo):
+        import lsst.daf.persistence as dafPersist
+        self.repo = repo
+        self.butler = dafPersist.Butler(repo)
+        self.catalogs = {}
+        self.dataIdIndexes = {}
+
+    def get(self, datasetType, dataId=None, immediate=True, **rest):
+        if datasetType != "src":
+            return self.butler.get(datasetType, dataId, immediate=immediate, **rest)
+        dataId = dict(dataId or {}, **rest)
+        key = tuple(sorted(dataId.items()))
+        if key not in self.catalogs:
+            self.catalogs[key] = self.butler.get("src", dataId, immediate=True)
+        return self.catalogs[key]
+
+    def dataIdIndex(self, inputRepo):
+        """Return the `dataids.DataIdIndex` of ``inputRepo``, knowing the src catalogs of the session."""
+        if inputRepo not in self.dataIdIndexes:
+            index = dataids.DataIdIndex(inputRepo)
+            index.addDatasets(self, self.repo, ["src"])
+            self.dataIdIndexes[inputRepo] = index
+        return self.dataIdIndexes[inputRepo]
+
+    def __getattr__(self, name):
+        return getattr(self.butler, name)
+
+
+def process(args):
+    """Run processCcd on the selected dataIds of the input repository."""
+    from lsst.pipe.tasks.processCcd import ProcessCcdTask
+    idArgs = []
+    for dataId in dataids.DataIdIndex(args.input).select(args.patterns):
+        idArgs += ["--id"] + dataids.formatDataId(dataId).split()
+    if not idArgs:
+        print("No dataId of %s matches %s." % (args.input, ", ".join(args.patterns)), file=sys.stderr)
+        return False
+    options = ["--output", args.output, "--configfile", args.config, "-j", str(args.jobs)]
+    ProcessCcdTask.parseAndRun(args=[args.input] + idArgs + options)
+    return True
+
+
+def export(args, session):
+    """Export the columns of the source catalogs of the selected dataIds to ``args.file``.
+
+    Return the exported table, as a structured array.
+    """
+    exporter = loadScript("export-results")
+    index = session.dataIdIndex(args.input)
+    # The full catalogs are read through the session, so that later stages
+    # find them in memory.
+    tables = [exporter.makeTable(exporter.readColumns(session, dataId, project=False))
+              for dataId in index.select(args.patterns, "src")]
+    fmt = os.path.splitext(args.file)[1][1:] or "txt"
+    if fmt == "txt":
+        with open(args.file, "w") as f:
+            if tables:
+                f.write("#" + " ".join(exporter.cols) + "\n")
+            for table in tables:
+                exporter.writeRows([table[col] for col in exporter.cols], f)
+    else:
+        with open(args.file, "wb") as f:
+            exporter.writeBinary(tables, fmt, f)
+    print("Exported %d sources of %d dataIds to %s." % (sum(len(t) for t in tables), len(tables), args.file))
+    return np.concatenate(tables) if tables else None
+
+
+def compareResults(args, table=None):
+    """Compare the exported table (read from ``args.file`` if not given) with its reference."""
+    reference = args.reference or compare.referenceFilename(args.file)
+    return compare.comparePair(table if table is not None else args.file, reference, args.tolerance,
+                               summary=args.summary)
+
+
+def checkAstrometry(args, session):
+    """Check the astrometric scatter of the selected dataIds, reading the catalogs through ``session``.
+
+    The runs, fields and camcols of the dataIds with a source catalog are
+    compared with the reference visit of `check_astrometry.defaultData`.
+    """
+    _, _, ref, refField, _, filter = check_astrometry.defaultData(args.output)
+    selected = session.dataIdIndex(args.input).select(args.patterns, "src")
+    runs, fields, camcols = check_astrometry.summarizeDataIds(selected)[:3]
+    if not runs:
+        print("No dataId of %s matches %s." % (args.output, ", ".join(args.patterns)), file=sys.stderr)
+        return False
+    return check_astrometry.main(args.output, runs, fields, ref, refField, camcols, args.filters or [filter],
+                                 plot=args.plot, matcher=args.matcher, butler=session)
+
+
+def main(args):
+    """Run the stage ``args.command``, or all of them; return True if it succeeded."""
+    if args.command in ("process", "all") and not process(args):
+        return False
+    if args.command == "process":
+        return True
+    if args.command == "compare":
+        return compareResults(args)
+    session = Session(args.output)
+    if args.command == "export":
+        export(args, session)
+        return True
+    if args.command == "check-astrometry":
+        return checkAstrometry(args, session)
+    table = export(args, session)
+    # run both checks, even if the first fails
+    compared = compareResults(args, table)
+    checked = checkAstrometry(args, session)
+    return compared and checked
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the stages of the demo in a single process.")
+    parser.add_argument('--small', action='store_true', help="Use the small dataset, as demo.sh --small.")
+    parser.add_argument('--input', default='input', help="Input repository (default: %(default)s).")
+    parser.add_argument('--output', help="Output repository (default: output, or output_small).")
+    parser.add_argument('--id', action='append', dest='patterns', metavar='PATTERN',
+                        help='Select the dataIds matching a pattern, e.g. "run=4192 filter=g^r"; may be '
+                        'given several times (default: the dataIds of the demo).')
+    parser.add_argument('--file', help="File of the exported sources, whose extension (.txt, .npy or "
+                        ".parquet) gives its format (default: detected-sources.txt, or "
+                        "detected-sources_small.txt).")
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+    subparsers.required = True
+    commands = {}
+    for name, doc in [("process", "process the dataIds with processCcd"),
+                      ("export", "export the columns of the source catalogs"),
+                      ("compare", "compare the exported sources with the expected results"),
+                      ("check-astrometry", "check the astrometric scatter"),
+                      ("all", "run all of the above")]:
+        commands[name] = subparsers.add_parser(name, help=doc, description=doc[0].upper() + doc[1:] + ".")
+    for name in ("process", "all"):
+        commands[name].add_argument('--config', default=os.path.join('config', 'processCcd.py'),
+                                    help="Config overrides of processCcd (default: %(default)s).")
+        commands[name].add_argument('-j', '--jobs', type=int, default=1,
+                                    help="Number of processes of processCcd (default: %(default)s).")
+    for name in ("compare", "all"):
+        commands[name].add_argument('--reference', help="Reference data for comparison (default: the "
+                                    "expected results of the platform).")
+        commands[name].add_argument('--tolerance', default=1e-10, type=float,
+                                    help="Tolerance for errors (default: %(default)s).")
+        commands[name].add_argument('--summary', type=int, default=0, metavar='N',
+                                    help="Summarize each failing column with its N worst rows.")
+    for name in ("check-astrometry", "all"):
+        commands[name].add_argument('--filters', nargs='+', help="Filters to check (default: i).")
+        commands[name].add_argument('--matcher', choices=sorted(check_astrometry.MATCHERS), default='afw',
+                                    help="Matching engine (default: %(default)s).")
+        commands[name].add_argument('--plot', action='store_true', help="Plot the astrometric scatter.")
+    args = parser.parse_args()
+    dataids.checkPatterns(parser, args.patterns)
+
+    sizeExt = "_small" if args.small else ""
+    args.output = args.output or "output" + sizeExt
+    args.file = args.file or "detected-sources%s.txt" % sizeExt
+    args.patterns = args.patterns or (SMALL_DATAID_PATTERNS if args.small else DATAID_PATTERNS)
+    if main(args):
+        print("Ok.")
+    else:
+        sys.exit(1)
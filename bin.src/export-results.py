@@ -1,12 +1,22 @@
 #!/usr/bin/env python
 from __future__ import division
 from __future__ import print_function
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
 import re
+import shutil
 import sys
+import tempfile
 import numpy as np
 import lsst.daf.persistence as dafPersist
 import lsst.log
 
+import dataids
+
 lsst.log.configure_prop("""
 log4j.rootLogger=INFO, A1
 log4j.appender.A1=ConsoleAppender
@@ -14,11 +24,6 @@ log4j.appender.A1.Target=System.err
 log4j.appender.A1.layout=PatternLayout
 """)
 
-if len(sys.argv) != 2:
-    print("Usage: export-results <output_directory>", file=sys.stderr)
-    exit(1)
-outputdir = sys.argv[1]
-
 # Load sources and print interesting columns
 
 cols = ("id",
@@ -51,41 +56,342 @@ cols = ("id",
         "base_ClassificationExtendedness_value",
         )
 
-headerPrinted = False
-butler = dafPersist.Butler(outputdir)
-for filter in "ugriz":
-    for dataId in (dict(run=4192, filter=filter, field=300, camcol=4),
-                   dict(run=6377, filter=filter, field=399, camcol=4),
-                   ):
-        if not butler.datasetExists("src", **dataId):
-            continue
-
-        srcs = butler.get("src", **dataId)
-        if not headerPrinted:
-            print('#' + ' '.join(cols))
-            headerPrinted = True
+# Number of rows formatted and written to stdout at a time.
+CHUNK_SIZE = 10000
+
+
+def getColumns(srcs):
+    """Return the exported columns of a source catalog as a list of arrays."""
+    vecs = []
+    for col in cols:
+        if col not in srcs.schema:
+            # If the column is not in the source table, we fill it
+            # with a "-". We can therefore check optional columns
+            # like ``flags_negative``.
+            v = ["-"] * len(srcs)
+        elif col.endswith(".ra") or col.endswith(".dec") or col.endswith("_ra") or col.endswith("_dec"):
+            v = np.rad2deg(srcs.get(col))
+        elif re.search(r"\.err\.(xx|yy|xy)$", col):
+            field, which = re.search(r"^(.*\.err)\.(xx|yy|xy)$", col).groups()
+            key = srcs.schema.find(field).key
+            key = key[0, 0] if which == "xx" else key[1, 1] if which == "yy" else key[0, 1]
+
+            v = srcs.get(key)
+        else:
+            v = srcs.get(col)
+        v = np.asarray(v)
+        vecs.append(v)
+    return vecs
+
+
+def readFitsColumns(filename):
+    """Read the exported columns straight from the FITS binary table of a src catalog.
+
+    Only the exported columns of the table are read, rather than the full
+    catalog with every measurement column.  Flag fields, which afw packs
+    into the bits of a single "flags" column, are located with the TFLAGn
+    header keywords, and schema aliases with the ALIAS keywords.
+
+    Return a list of arrays as `getColumns` does, or None if astropy is not
+    available or the table cannot be read this way.
+    """
+    try:
+        from astropy.io import fits
+    except ImportError:
+        return None
+    with fits.open(filename, memmap=True) as hdus:
+        if len(hdus) < 2 or not isinstance(hdus[1], fits.BinTableHDU):
+            return None
+        hdu = hdus[1]
+        names = set(hdu.columns.names)
+        flagBits = {}
+        aliases = {}
+        for card in hdu.header.cards:
+            match = re.match(r"^TFLAG(\d+)$", card.keyword)
+            if match:
+                flagBits[card.value] = int(match.group(1)) - 1
+            elif card.keyword == "ALIAS":
+                alias, target = card.value.split(":", 1)
+                aliases[alias] = target
+
+        data = hdu.data
         vecs = []
         for col in cols:
-            if col not in srcs.schema:
-                # If the column is not in the source table, we fill it
-                # with a "-". We can therefore check optional columns
-                # like ``flags_negative``.
-                v = ["-"] * len(srcs)
-            elif col.endswith(".ra") or col.endswith(".dec") or col.endswith("_ra") or col.endswith("_dec"):
-                v = np.rad2deg(srcs.get(col))
-            elif re.search(r"\.err\.(xx|yy|xy)$", col):
-                field, which = re.search(r"^(.*\.err)\.(xx|yy|xy)$", col).groups()
-                key = srcs.schema.find(field).key
-                key = key[0, 0] if which == "xx" else key[1, 1] if which == "yy" else key[0, 1]
-
-                v = srcs.get(key)
+            if re.search(r"\.err\.(xx|yy|xy)$", col):
+                return None
+            name = col
+            for i in range(len(aliases)):
+                if name not in aliases:
+                    break
+                name = aliases[name]
+            if name in names:
+                v = data.field(name)
+            elif name in flagBits and "flags" in names:
+                v = data.field("flags")[:, flagBits[name]]
             else:
-                v = srcs.get(col)
-            v = np.asarray(v)
+                v = np.array(["-"] * len(data))
+            # Copy out of the memory map, in native byte order.
+            v = np.array(v, dtype=v.dtype.newbyteorder("="))
+            if col.endswith(".ra") or col.endswith(".dec") or col.endswith("_ra") or col.endswith("_dec"):
+                v = np.rad2deg(v)
             vecs.append(v)
+    return vecs
+
+
+def readColumns(butler, dataId, project=True):
+    """Return the exported columns of the src catalog of ``dataId``.
+
+    If ``project``, only the exported columns are read (see
+    `readFitsColumns`); the full catalog is read through the butler if that
+    is disabled or not possible.
+    """
+    vecs = readFitsColumns(butler.getUri("src", dataId)) if project else None
+    if vecs is None:
+        vecs = getColumns(butler.get("src", **dataId))
+    return vecs
+
+
+def writeRows(vecs, out, chunkSize=CHUNK_SIZE):
+    """Write the rows of the given columns to ``out``, whitespace separated.
+
+    The format of each column is determined once from its dtype, and rows
+    are formatted ``chunkSize`` at a time with a single string formatting
+    operation, rather than element by element.
+    """
+    # To future proof the comparison, we use an explicit format for floating point types since a
+    # default format could be ambiguous.
+    rowFormat = ' '.join(['%.12g' if issubclass(v.dtype.type, np.floating) else '%s'
+                          for v in vecs]) + '\n'
+    # ``tolist`` converts to the equivalent Python scalars, which format
+    # identically to the NumPy ones.
+    columns = [v.tolist() for v in vecs]
+    nCols = len(columns)
+    nRows = len(columns[0]) if columns else 0
+    for start in range(0, nRows, chunkSize):
+        stop = min(start + chunkSize, nRows)
+        values = [None]*((stop - start)*nCols)
+        for i, column in enumerate(columns):
+            values[i::nCols] = column[start:stop]
+        out.write((rowFormat*(stop - start)) % tuple(values))
+
+
+def makeTable(vecs):
+    """Return the given columns as a NumPy structured array with the names in ``cols``.
+
+    Columns keep their native types (flags are booleans); columns missing
+    from the source table are filled with "-", as in the text output.
+    """
+    table = np.empty(len(vecs[0]), dtype=[(col, v.dtype) for col, v in zip(cols, vecs)])
+    for col, v in zip(cols, vecs):
+        table[col] = v
+    return table
+
+
+def writeBinary(tables, fmt, out):
+    """Write the concatenated structured arrays ``tables`` to the binary stream ``out``."""
+    try:
+        table = np.concatenate(tables) if tables else np.empty(0, dtype=[(col, float) for col in cols])
+    except TypeError:
+        raise RuntimeError("Source catalogs do not all have the same exported columns.")
+    if fmt == 'npy':
+        np.save(out, table, allow_pickle=False)
+    elif fmt == 'parquet':
+        # pyarrow is only needed for this format.
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        pq.write_table(pa.table({col: table[col] for col in cols}), out)
+    else:
+        raise ValueError("Unknown binary format: %s" % (fmt,))
+
+
+def fileDigest(filename, blockSize=1 << 20):
+    """Return the SHA-1 hex digest of the contents of ``filename``."""
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blockSize), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# Name of the file of the fragment cache recording the size, modification
+# time and digest of each src file.
+INDEX_FILE = "index.json"
+
+
+def loadIndex(cacheDir):
+    """Return the index of the fragment cache in ``cacheDir``."""
+    path = os.path.join(cacheDir, INDEX_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def saveIndex(cacheDir, index):
+    """Write the index of the fragment cache in ``cacheDir``."""
+    tmp = os.path.join(cacheDir, INDEX_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.rename(tmp, os.path.join(cacheDir, INDEX_FILE))
+
+
+def fragmentPath(butler, dataId, fmt, cacheDir, index, project=True):
+    """Return the path of the cached exported block of ``dataId``.
+
+    The block is stored as text rows for the text format and as a ``.npy``
+    structured array otherwise, under a name which includes a digest of the
+    src file and of the exported columns.  The digest of the src file is
+    taken from ``index`` if the size and modification time of the file have
+    not changed, and computed from its contents otherwise.  The block is only
+    (re)created if no block with the current digest exists, in which case
+    blocks of earlier versions of the src file are removed.
+
+    The columns are read as `readColumns` does with ``project``.
+
+    Return the path, the src file name, and its index entry.
+    """
+    uri = butler.getUri("src", dataId)
+    stat = os.stat(uri)
+    entry = index.get(uri)
+    if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+        entry = dict(size=stat.st_size, mtime=stat.st_mtime, digest=fileDigest(uri))
+
+    ext = 'txt' if fmt == 'txt' else 'npy'
+    sha = hashlib.sha1(' '.join(cols).encode())
+    sha.update(entry["digest"].encode())
+    name = "%(run)d-%(filter)s-%(camcol)d-%(field)d" % dataId
+    path = os.path.join(cacheDir, "%s-%s.%s" % (name, sha.hexdigest(), ext))
+    if os.path.exists(path):
+        return path, uri, entry
+
+    for stale in glob.glob(os.path.join(cacheDir, "%s-*.%s" % (name, ext))):
+        os.remove(stale)
+    vecs = readColumns(butler, dataId, project)
+    tmp = path + ".tmp"
+    if ext == 'txt':
+        with open(tmp, 'w') as f:
+            writeRows(vecs, f)
+    else:
+        with open(tmp, 'wb') as f:
+            np.save(f, makeTable(vecs), allow_pickle=False)
+    os.rename(tmp, path)
+    return path, uri, entry
+
+
+# Per-process butlers of `exportFragment`, by repository.
+_butlers = {}
+
+
+def exportFragment(args):
+    """Export the block of one dataId to the fragment cache.
+
+    This is run by the worker processes of `main`, each of which only
+    creates its butler once.
+
+    @param args  Tuple of (outputdir, dataId, fmt, cacheDir, index, project).
+
+    Return the result of `fragmentPath`.
+    """
+    outputdir, dataId, fmt, cacheDir, index, project = args
+    if outputdir not in _butlers:
+        _butlers[outputdir] = dafPersist.Butler(outputdir)
+    return fragmentPath(_butlers[outputdir], dataId, fmt, cacheDir, index, project)
+
+
+def main(outputdir, fmt, cacheDir=None, jobs=1, project=True, inputdir=None, patterns=None):
+    """Export the source catalogs of ``outputdir`` to stdout in format ``fmt``.
+
+    The catalogs exported are those of the dataIds of the registry of
+    ``inputdir`` (by default, the input repository of ``outputdir``, see
+    `dataids.DataIdIndex.fromOutputRepo`) matching any of ``patterns`` (all
+    if None), in the order of `dataids.sortKey`.
+
+    Without ``cacheDir`` and with a single job, each catalog is written
+    straight to stdout.  Otherwise, the block of each dataId is exported to
+    a fragment in ``cacheDir`` (or a temporary directory) by ``jobs``
+    processes, and the output assembled by concatenating the fragments in
+    order.  Unless ``project`` is False, only the exported columns of each
+    catalog are read.
+    """
+    butler = dafPersist.Butler(outputdir)
+    _butlers[outputdir] = butler
+    if inputdir is None:
+        dataIdIndex = dataids.DataIdIndex.fromOutputRepo(butler, outputdir)
+    else:
+        dataIdIndex = dataids.DataIdIndex(inputdir)
+    dataIdIndex.addDatasets(butler, outputdir, ["src"])
+    dataIds = dataIdIndex.select(patterns, "src")
+
+    if cacheDir is None and jobs <= 1:
+        tables = []
+        for dataId in dataIds:
+            vecs = readColumns(butler, dataId, project)
+            if fmt != 'txt':
+                tables.append(makeTable(vecs))
+                continue
+            if dataId is dataIds[0]:
+                print('#' + ' '.join(cols))
+            writeRows(vecs, sys.stdout)
+        if fmt != 'txt':
+            writeBinary(tables, fmt, sys.stdout.buffer)
+        return
+
+    tmpDir = None
+    if cacheDir is None:
+        cacheDir = tmpDir = tempfile.mkdtemp(prefix="export-")
+    elif not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    try:
+        index = loadIndex(cacheDir)
+        tasks = [(outputdir, dataId, fmt, cacheDir, index, project) for dataId in dataIds]
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                results = pool.map(exportFragment, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [exportFragment(task) for task in tasks]
+        for path, uri, entry in results:
+            index[uri] = entry
+        saveIndex(cacheDir, index)
+
+        paths = [path for path, uri, entry in results]
+        if fmt != 'txt':
+            writeBinary([np.load(path) for path in paths], fmt, sys.stdout.buffer)
+            return
+        if paths:
+            print('#' + ' '.join(cols))
+        for path in paths:
+            with open(path, 'r') as f:
+                shutil.copyfileobj(f, sys.stdout)
+    finally:
+        if tmpDir is not None:
+            shutil.rmtree(tmpDir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the interesting columns of the source catalogs.")
+    parser.add_argument('outputdir', help="Output repository of processCcd.")
+    parser.add_argument('--format', default='txt', choices=('txt', 'npy', 'parquet'),
+                        help="Format written to stdout: whitespace separated text, or a typed, columnar "
+                        "NumPy structured array (.npy) or Parquet table.")
+    parser.add_argument('--cache-dir', help="Directory in which the exported block of each dataId is "
+                        "cached, keyed by the contents of its src file, so that only new or changed "
+                        "catalogs are read and exported again.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of processes exporting dataIds concurrently (default: %(default)s).")
+    parser.add_argument('--full-read', action='store_true',
+                        help="Read each source catalog in full through the butler, rather than only the "
+                        "exported columns of its FITS table.")
+    parser.add_argument('--input', help="Input repository, whose registry lists the dataIds (default: "
+                        "the input repository of outputdir).")
+    parser.add_argument('--id', action='append', dest='patterns', metavar='PATTERN',
+                        help='Only export the dataIds matching a pattern, e.g. "run=4192 filter=g^r"; may be '
+                        'given several times (default: all dataIds).')
+    args = parser.parse_args()
+    dataids.checkPatterns(parser, args.patterns)
 
-        for vals in zip(*vecs):
-            # To future proof the comparison, we use an explicit format for floating point types since a
-            # default format could be ambiguous.
-            print(' '.join(['{0:.12g}'.format(el) if issubclass(el.dtype.type, np.floating)
-                            else str(el) for el in vals]))
+    main(args.outputdir, args.format, cacheDir=args.cache_dir, jobs=args.jobs, project=not args.full_read,
+         inputdir=args.input, patterns=args.patterns)
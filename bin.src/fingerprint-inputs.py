@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Print a fingerprint of the inputs of processCcd for each dataId.
+
+The fingerprint of a dataId is a digest of the contents of its raw frames
+(fpC, fpM) and calibration files (psField, tsField, asTrans), of the config
+file and the reference object loader it uses, of the reference catalog and
+mapper of the input repository, and of the versions of the stack products
+which are set up.  It changes whenever
+reprocessing the dataId could give a different result.
+
+Each dataId is given as a single argument of space separated key=value
+pairs, e.g. "run=4192 filter=g camcol=4 field=300", and a line
+"<fingerprint> <dataId>" is printed for each of them.
+"""
+from __future__ import print_function
+
+import argparse
+import glob
+import hashlib
+import os
+import sys
+
+# Patterns of the files of a dataId in the input repository, relative to
+# <input>/<run>/<rerun>.
+DATAID_FILES = ("corr/%(camcol)d/fpC-%(run)06d-%(filter)s%(camcol)d-%(field)04d.fit*",
+                "objcs/%(camcol)d/fpM-%(run)06d-%(filter)s%(camcol)d-%(field)04d.fit*",
+                "objcs/%(camcol)d/psField-%(run)06d-%(camcol)d-%(field)04d.fit*",
+                "calibChunks/%(camcol)d/tsField-%(run)06d-%(camcol)d-*-%(field)04d.fit*",
+                "astrom/asTrans-%(run)06d.fit*",
+                )
+
+# eups products whose version affects the processing.
+PRODUCTS = ("LSST_DISTRIB", "OBS_SDSS", "PIPE_TASKS", "MEAS_ALGORITHMS", "AFW")
+
+# The reference object loader of config/processCcd.py, in the python
+# directory of the package (this script is in bin.src, or bin once built).
+REFCAT_LOADER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             "python", "lsst", "dm_stack_demo", "refcatLoader.py")
+
+
+def fileDigest(filename, blockSize=1 << 20):
+    """Return the SHA-1 hex digest of the contents of ``filename``."""
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blockSize), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def parseDataId(text):
+    """Parse a "key=value key=value" string into a dataId dict."""
+    dataId = {}
+    for item in text.split():
+        key, value = item.split("=")
+        dataId[key] = value if key == "filter" else int(value)
+    return dataId
+
+
+def dataIdFiles(inputDir, dataId):
+    """Return the sorted list of the input files of ``dataId``."""
+    files = []
+    for pattern in DATAID_FILES:
+        files.extend(glob.glob(os.path.join(inputDir, "%d" % dataId["run"], "*", pattern % dataId)))
+    return sorted(files)
+
+
+def commonFiles(inputDir, configFile):
+    """Return the sorted list of the input files shared by all dataIds."""
+    # config/processCcd.py retargets the reference object loaders to the
+    # task of lsst.dm_stack_demo.refcatLoader.
+    files = [configFile, os.path.join(inputDir, "_mapper"), REFCAT_LOADER]
+    for dirpath, dirnames, filenames in os.walk(os.path.join(inputDir, "ref_cats")):
+        # The shard index of refcat.py is derived from the shards.
+        files.extend(os.path.join(dirpath, f) for f in filenames if not f.startswith("shard-index.json"))
+    return sorted(f for f in files if os.path.isfile(f))
+
+
+def main(inputDir, configFile, dataIds):
+    """Print the fingerprint of each of ``dataIds``.
+
+    Return False if no input files were found for a dataId.
+    """
+    common = hashlib.sha1()
+    for filename in commonFiles(inputDir, configFile):
+        common.update(("%s %s\n" % (os.path.relpath(filename, inputDir), fileDigest(filename))).encode())
+    for product in PRODUCTS:
+        common.update(("%s %s\n" % (product, os.environ.get("SETUP_" + product, ""))).encode())
+
+    valid = True
+    for text in dataIds:
+        files = dataIdFiles(inputDir, parseDataId(text))
+        if not files:
+            print("No input files found for %s." % (text,), file=sys.stderr)
+            valid = False
+            continue
+        sha = common.copy()
+        for filename in files:
+            sha.update(("%s %s\n" % (os.path.relpath(filename, inputDir), fileDigest(filename))).encode())
+        print(sha.hexdigest(), text)
+    return valid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print a fingerprint of the inputs of each dataId.")
+    parser.add_argument('input', help="Input repository.")
+    parser.add_argument('config', help="Config file of processCcd.")
+    parser.add_argument('dataIds', nargs='+', metavar='dataId', help='dataId, e.g. "run=4192 filter=g '
+                        'camcol=4 field=300".')
+    args = parser.parse_args()
+
+    if not main(args.input, args.config, args.dataIds):
+        sys.exit(1)
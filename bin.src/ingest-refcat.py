@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""Ingest a FITS catalog into an HTM-indexed reference catalog, in parallel.
+
+This does what ``ingestReferenceCatalog.py`` does with the configuration in
+ref_cat/config.py, for catalogs too large to be ingested serially: the input
+table is read in chunks of rows, and each chunk is converted to the reference
+catalog schema and split by HTM trixel by a pool of worker processes, which
+append the rows of each shard to per-shard buffers on disk.  Each shard is
+then written by the pool from its buffers, in the order of the input rows.
+
+The schema and headers of the shards, and the config of the catalog, are
+copied from an existing catalog (by default, sdss_demo_ref_cat), with the
+HTM depth of the config set to the one used, so the output can be read by
+the stack's reference object loaders.  For example::
+
+    $ python bin.src/ingest-refcat.py ref_cat/stars.fits /tmp/sdss_ref_cat --jobs 4
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import glob
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import refcat
+
+# Catalog whose schema, headers and config are used for the output.
+DEFAULT_TEMPLATE = os.path.join("input", "ref_cats", "sdss_demo_ref_cat")
+
+# Flux in nJy of an AB magnitude of 0.  IngestIndexedReferenceTask converts
+# magnitudes with astropy (10**(-0.4*48.6) erg/s/cm^2/Hz), but magnitude
+# errors with afw (3631 Jy).
+AB_FLUX_SCALE = 10**(-0.4*48.6)*1e32
+AB_FLUX_ERR_SCALE = 3631e9
+
+
+def convertChunk(data, dtype, columns):
+    """Convert input rows to the reference catalog schema.
+
+    @param data     Structured array of input rows.
+    @param dtype    Record dtype of the shards.
+    @param columns  Dict of the input columns: "id", "ra" and "dec" (in
+                    degrees), "mags" (list of (filter, mag, magErr) column
+                    names) and "extra" (list of columns copied as is).
+    """
+    records = np.empty(len(data), dtype=dtype)
+    records["id"] = data[columns["id"]]
+    records["coord_ra"] = np.deg2rad(data[columns["ra"]]) % (2*np.pi)
+    records["coord_dec"] = np.deg2rad(data[columns["dec"]])
+    for filter, mag, magErr in columns["mags"]:
+        scale = 10**(-0.4*data[mag])
+        records[filter + "_flux"] = AB_FLUX_SCALE*scale
+        records[filter + "_fluxErr"] = np.abs(0.4*np.log(10)*data[magErr]*AB_FLUX_ERR_SCALE*scale)
+    for name in columns["extra"]:
+        records[name] = data[name]
+    return records
+
+
+def ingestChunk(args):
+    """Convert a chunk of input rows, and append them to the buffers of their shards.
+
+    @param args  Tuple of (inputFile, start, stop, chunk, descr, columns,
+                 depth, bufferDir); the rows [start, stop) of ``inputFile``
+                 are appended to ``<bufferDir>/<shard>/<chunk>.npy``.
+
+    Return the number of rows of the chunk, and the ids of the shards it
+    touched.
+    """
+    inputFile, start, stop, chunk, descr, columns, depth, bufferDir = args
+    # astropy is only needed to read and write the catalogs.
+    from astropy.io import fits
+    with fits.open(inputFile, memmap=True) as hdus:
+        data = np.array(hdus[1].data[start:stop])
+    records = convertChunk(data, refcat.makeDtype(descr), columns)
+    shardIds = refcat.htmIndex(refcat.unitVector(records["coord_ra"], records["coord_dec"]), depth)
+    # a stable sort keeps the input order of the rows of each shard
+    order = np.argsort(shardIds, kind="mergesort")
+    shardIds, records = shardIds[order], records[order]
+    ids, starts = np.unique(shardIds, return_index=True)
+    for shardId, begin, end in zip(ids, starts, list(starts[1:]) + [len(records)]):
+        shardDir = os.path.join(bufferDir, "%d" % shardId)
+        if not os.path.isdir(shardDir):
+            try:
+                os.makedirs(shardDir)
+            except OSError:
+                # created by another worker in the meantime
+                pass
+        np.save(os.path.join(shardDir, "%08d.npy" % chunk), records[begin:end], allow_pickle=False)
+    return stop - start, ids.tolist()
+
+
+def writeShard(args):
+    """Write a shard from its buffers.
+
+    @param args  Tuple of (shardId, bufferDir, outputDir, template).
+
+    Return the number of rows of the shard.
+    """
+    shardId, bufferDir, outputDir, template = args
+    from astropy.io import fits
+    buffers = sorted(glob.glob(os.path.join(bufferDir, "%d" % shardId, "*.npy")))
+    records = np.concatenate([np.load(f) for f in buffers])
+    with fits.open(os.path.join(template, "master_schema.fits")) as schema:
+        primary = fits.PrimaryHDU(header=schema[0].header.copy())
+        table = fits.BinTableHDU.from_columns([fits.Column(name=c.name, format=c.format, unit=c.unit,
+                                                           array=records[c.name])
+                                               for c in schema[1].columns])
+        # keep the afw keywords (TDOCn, TCCLSn, AFW_TYPE, ...) of the schema
+        for card in schema[1].header.cards:
+            if card.keyword not in table.header:
+                table.header.append(card)
+    tmp = os.path.join(outputDir, "%d.fits.tmp" % shardId)
+    fits.HDUList([primary, table]).writeto(tmp)
+    os.rename(tmp, os.path.join(outputDir, "%d.fits" % shardId))
+    return len(records)
+
+
+def writeConfig(template, outputDir, depth):
+    """Copy the config of the catalog ``template`` to ``outputDir``, with its HTM depth set to ``depth``."""
+    with open(os.path.join(template, "config.py")) as f:
+        config = f.read()
+    line = "config.indexer['HTM'].depth=%d" % depth
+    config, n = re.subn(r"^config\.indexer\['HTM'\]\.depth\s*=.*$", line, config, flags=re.MULTILINE)
+    if n == 0:
+        config += "\n# Depth of the HTM tree to make.\n%s\n" % line
+    with open(os.path.join(outputDir, "config.py"), "w") as f:
+        f.write(config)
+
+
+def chunkArgs(inputFile, rows, chunkSize, descr, columns, depth, bufferDir):
+    """Return the arguments of `ingestChunk` for each chunk of ``inputFile``."""
+    return [(inputFile, start, min(start + chunkSize, rows), chunk, descr, columns, depth, bufferDir)
+            for chunk, start in enumerate(range(0, rows, chunkSize))]
+
+
+def main(inputFile, outputDir, columns, template=DEFAULT_TEMPLATE, depth=7, chunkSize=1000000, jobs=1):
+    """Ingest ``inputFile`` into the reference catalog ``outputDir``, printing progress and timing.
+
+    Return False if ``outputDir`` already holds shards.
+    """
+    from astropy.io import fits
+    if glob.glob(os.path.join(outputDir, "[0-9]*.fits")):
+        print("%s already contains a reference catalog." % (outputDir,), file=sys.stderr)
+        return False
+    if not os.path.isdir(outputDir):
+        os.makedirs(outputDir)
+    with fits.open(inputFile, memmap=True) as hdus:
+        rows = hdus[1].header["NAXIS2"]
+    with fits.open(os.path.join(template, "master_schema.fits")) as schema:
+        descr = schema[1].data.dtype.descr
+
+    start = time.time()
+    bufferDir = tempfile.mkdtemp(prefix="ingest-", dir=outputDir)
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    imap = pool.imap_unordered if pool else map
+    try:
+        shardIds = set()
+        done = 0
+        for n, ids in imap(ingestChunk, chunkArgs(inputFile, rows, chunkSize, descr, columns, depth,
+                                                  bufferDir)):
+            done += n
+            shardIds.update(ids)
+            elapsed = time.time() - start
+            print("\rRead %d/%d rows (%.0f%%) in %.1f s, %.0f rows/s" %
+                  (done, rows, 100*done/max(rows, 1), elapsed, done/elapsed if elapsed > 0 else 0),
+                  end="", file=sys.stderr)
+        print(file=sys.stderr)
+        readTime = time.time() - start
+
+        written = 0
+        for i, n in enumerate(imap(writeShard, [(shardId, bufferDir, outputDir, template)
+                                                for shardId in sorted(shardIds)])):
+            written += n
+            print("\rWrote %d/%d shards" % (i + 1, len(shardIds)), end="", file=sys.stderr)
+        print(file=sys.stderr)
+        writeTime = time.time() - start - readTime
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        shutil.rmtree(bufferDir)
+
+    shutil.copy(os.path.join(template, "master_schema.fits"), outputDir)
+    writeConfig(template, outputDir, depth)
+    refcat.ShardIndex(outputDir)
+    total = time.time() - start
+    print("Ingested %d rows into %d shards in %.2f s (%.0f rows/s) with %d jobs:" %
+          (written, len(shardIds), total, written/total if total > 0 else 0, jobs))
+    print("  read, convert and index  %8.2f s" % readTime)
+    print("  write shards             %8.2f s" % writeTime)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest a FITS catalog into an HTM-indexed reference "
+                                     "catalog, in parallel.")
+    parser.add_argument('input', help="Input FITS catalog, with magnitudes (as ref_cat/stars.fits).")
+    parser.add_argument('output', help="Directory of the reference catalog to create.")
+    parser.add_argument('--template', default=DEFAULT_TEMPLATE,
+                        help="Reference catalog whose schema and config are used (default: %(default)s).")
+    parser.add_argument('--depth', type=int, default=7,
+                        help="HTM depth of the shards (default: %(default)s).")
+    parser.add_argument('--chunk-size', type=int, default=1000000,
+                        help="Number of input rows per chunk (default: %(default)s).")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of worker processes (default: %(default)s).")
+    parser.add_argument('--ra', default='ra',
+                        help="Name of the RA column, in degrees (default: %(default)s).")
+    parser.add_argument('--dec', default='dec',
+                        help="Name of the Dec column, in degrees (default: %(default)s).")
+    parser.add_argument('--id', default='sdssid', help="Name of the id column (default: %(default)s).")
+    parser.add_argument('--filters', default='ugriz',
+                        help="Filters; the magnitude and error columns of filter f are f and f_err "
+                        "(default: %(default)s).")
+    parser.add_argument('--extra', nargs='*', default=['starnotgal'],
+                        help="Columns copied as is (default: %(default)s).")
+    args = parser.parse_args()
+
+    columns = dict(id=args.id, ra=args.ra, dec=args.dec, extra=args.extra,
+                   mags=[(f, f, f + "_err") for f in args.filters])
+    if not main(args.input, args.output, columns, template=args.template, depth=args.depth,
+                chunkSize=args.chunk_size, jobs=args.jobs):
+        sys.exit(1)
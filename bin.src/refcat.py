@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""Fast access to the shards of an HTM-indexed reference catalog.
+
+An indexed reference catalog, as written by IngestIndexedReferenceTask, is a
+directory of FITS files named after the HTM trixel ("shard") they cover.
+`ShardIndex` keeps a sidecar index of the shards of such a catalog, with the
+byte range, row count, record layout and sky footprint (RA/Dec bounding box
+and bounding cap) of the table of each shard.  Cone queries then only
+memory-map the table data of the shards overlapping the cone, without
+opening or parsing their FITS headers.
+
+The index is built with astropy the first time it is needed, saved as
+``shard-index.json`` in the catalog directory, and brought up to date
+whenever a shard is added, removed or modified.
+
+Run this script to (re)build the index of a catalog, or to time a cone
+query, e.g.::
+
+    $ python bin.src/refcat.py input/ref_cats/sdss_demo_ref_cat --cone 352 0 0.3
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+# Name of the sidecar index in the catalog directory.
+INDEX_FILE = "shard-index.json"
+
+# Version of the format of the index; indexes of other versions are rebuilt.
+INDEX_VERSION = 1
+
+
+def unitVector(ra, dec):
+    """Return the unit vectors of the positions ``ra``, ``dec`` in radians."""
+    cosDec = np.cos(dec)
+    return np.stack([cosDec*np.cos(ra), cosDec*np.sin(ra), np.sin(dec)], axis=-1)
+
+
+# Vertices of the octahedron from which the HTM trixels are derived, and the
+# vertices of the 8 root trixels S0-S3 (ids 8-11) and N0-N3 (ids 12-15).
+HTM_VERTICES = np.array([[0, 0, 1], [1, 0, 0], [0, 1, 0], [-1, 0, 0], [0, -1, 0], [0, 0, -1]], dtype=float)
+HTM_ROOTS = ((1, 5, 2), (2, 5, 3), (3, 5, 4), (4, 5, 1), (1, 0, 4), (4, 0, 3), (3, 0, 2), (2, 0, 1))
+
+
+def _inside(vectors, v0, v1, v2):
+    """Return whether each of ``vectors`` is in its trixel (v0, v1, v2)."""
+    inside = np.einsum("ij,ij->i", np.cross(v0, v1), vectors) >= 0
+    inside &= np.einsum("ij,ij->i", np.cross(v1, v2), vectors) >= 0
+    inside &= np.einsum("ij,ij->i", np.cross(v2, v0), vectors) >= 0
+    return inside
+
+
+def _midpoint(v0, v1):
+    """Return the normalized midpoints of the edges (v0, v1)."""
+    w = v0 + v1
+    return w/np.linalg.norm(w, axis=1)[:, np.newaxis]
+
+
+def htmIndex(vectors, depth):
+    """Return the HTM ids at ``depth`` of the unit vectors ``vectors``.
+
+    The ids are those of `lsst.sphgeom.HtmPixelization`; all vectors descend
+    the trixel tree together, one level at a time.
+    """
+    n = len(vectors)
+    ids = np.full(n, -1, dtype=np.int64)
+    v0, v1, v2 = np.empty((n, 3)), np.empty((n, 3)), np.empty((n, 3))
+    for root, (i0, i1, i2) in enumerate(HTM_ROOTS):
+        corners = [np.broadcast_to(HTM_VERTICES[i], (n, 3)) for i in (i0, i1, i2)]
+        found = (ids < 0) & _inside(vectors, *corners)
+        ids[found] = 8 + root
+        v0[found], v1[found], v2[found] = HTM_VERTICES[i0], HTM_VERTICES[i1], HTM_VERTICES[i2]
+    for level in range(depth):
+        w0, w1, w2 = _midpoint(v1, v2), _midpoint(v0, v2), _midpoint(v0, v1)
+        children = ((v0, w2, w1), (v1, w0, w2), (v2, w1, w0), (w0, w1, w2))
+        child = np.full(n, 3, dtype=np.int64)
+        for i in (2, 1, 0):
+            child[_inside(vectors, *children[i])] = i
+        ids = 4*ids + child
+        v0, v1, v2 = [np.choose(child[:, np.newaxis], [c[k] for c in children]) for k in range(3)]
+    return ids
+
+
+def scanShard(filename):
+    """Return the index entry of the shard ``filename``.
+
+    The entry holds the byte ranges of the header and data of the table
+    HDU, its row count and record layout, and the bounding box and bounding
+    cap in degrees of the positions of its rows.
+    """
+    # astropy is only needed to build the index.
+    from astropy.io import fits
+    with fits.open(filename, memmap=True) as hdus:
+        info = hdus.fileinfo(1)
+        data = hdus[1].data
+        rows = len(data)
+        entry = dict(file=os.path.basename(filename),
+                     header=[info["hdrLoc"], info["datLoc"]],
+                     data=[info["datLoc"], info["datLoc"] + rows*data.itemsize],
+                     rows=rows,
+                     dtype=data.dtype.descr)
+        if rows == 0:
+            return entry
+        ra = np.asarray(data.field("coord_ra"), dtype=float)
+        dec = np.asarray(data.field("coord_dec"), dtype=float)
+    vectors = unitVector(ra, dec)
+    center = vectors.sum(axis=0)
+    center /= np.linalg.norm(center)
+    radius = np.arccos(np.clip(vectors.dot(center), -1, 1)).max()
+    raDeg = np.rad2deg(ra) % 360
+    # Shards straddling RA=0 get a box with raMin < 0.
+    if raDeg.max() - raDeg.min() > 180:
+        raDeg = np.where(raDeg > 180, raDeg - 360, raDeg)
+    entry.update(ra=[raDeg.min(), raDeg.max()],
+                 dec=[np.rad2deg(dec.min()), np.rad2deg(dec.max())],
+                 center=[np.rad2deg(np.arctan2(center[1], center[0])) % 360,
+                         np.rad2deg(np.arcsin(center[2]))],
+                 radius=np.rad2deg(radius))
+    return entry
+
+
+def makeDtype(descr):
+    """Return the dtype of a record layout stored in the index as JSON."""
+    fields = []
+    for field in descr:
+        fields.append(tuple(field[:2]) + ((tuple(field[2]),) if len(field) > 2 else ()))
+    return np.dtype(fields)
+
+
+class ShardIndex(object):
+    """Sidecar index of the shards of an HTM-indexed reference catalog.
+
+    @param refCatDir  Directory of the catalog, e.g.
+                      ``input/ref_cats/sdss_demo_ref_cat``.
+    @param indexFile  Path of the index; defaults to `INDEX_FILE` in
+                      ``refCatDir``.  If it cannot be written, the index is
+                      only kept in memory.
+    """
+
+    def __init__(self, refCatDir, indexFile=None):
+        self.refCatDir = refCatDir
+        self.indexFile = indexFile or os.path.join(refCatDir, INDEX_FILE)
+        self.shards = {}
+        if os.path.exists(self.indexFile):
+            with open(self.indexFile) as f:
+                index = json.load(f)
+            if index.get("version") == INDEX_VERSION:
+                self.shards = {int(shardId): entry for shardId, entry in index["shards"].items()}
+        self.update()
+
+    def update(self):
+        """Bring the index up to date with the shard files of the catalog.
+
+        Only new or modified shards are scanned.  Return True if the index
+        changed.
+        """
+        files = {}
+        for name in os.listdir(self.refCatDir):
+            match = re.match(r"^(\d+)\.fits$", name)
+            if match:
+                files[int(match.group(1))] = os.path.join(self.refCatDir, name)
+
+        changed = False
+        for shardId in set(self.shards) - set(files):
+            del self.shards[shardId]
+            changed = True
+        for shardId, filename in files.items():
+            stat = os.stat(filename)
+            entry = self.shards.get(shardId)
+            if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                continue
+            entry = scanShard(filename)
+            entry.update(size=stat.st_size, mtime=stat.st_mtime)
+            self.shards[shardId] = entry
+            changed = True
+        if changed:
+            self.save()
+        return changed
+
+    def save(self):
+        """Write the index to `indexFile`, if possible."""
+        index = dict(version=INDEX_VERSION,
+                     shards={str(shardId): entry for shardId, entry in self.shards.items()})
+        tmp = self.indexFile + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(index, f, indent=1, sort_keys=True)
+            os.rename(tmp, self.indexFile)
+        except (IOError, OSError):
+            pass
+
+    def overlapping(self, ra, dec, radius):
+        """Return the sorted ids of the shards overlapping a cone.
+
+        @param ra, dec  Center of the cone in degrees.
+        @param radius   Radius of the cone in degrees.
+        """
+        center = unitVector(np.deg2rad(ra), np.deg2rad(dec))
+        shardIds = []
+        for shardId, entry in self.shards.items():
+            if entry["rows"] == 0:
+                continue
+            shardCenter = unitVector(*np.deg2rad(entry["center"]))
+            distance = np.rad2deg(np.arccos(np.clip(center.dot(shardCenter), -1, 1)))
+            if distance <= radius + entry["radius"]:
+                shardIds.append(shardId)
+        return sorted(shardIds)
+
+    def readShard(self, shardId):
+        """Return the table of a shard as a read-only memory-mapped record array.
+
+        The records are in the big-endian layout of the FITS file.
+        """
+        entry = self.shards[shardId]
+        return np.memmap(os.path.join(self.refCatDir, entry["file"]), dtype=makeDtype(entry["dtype"]),
+                         mode="r", offset=entry["data"][0], shape=(entry["rows"],))
+
+    def coneSearch(self, ra, dec, radius):
+        """Return the rows of the catalog within a cone.
+
+        @param ra, dec  Center of the cone in degrees.
+        @param radius   Radius of the cone in degrees.
+
+        Return a structured array in native byte order, with the columns of
+        the catalog (positions are in radians, as in the shards).
+        """
+        center = unitVector(np.deg2rad(ra), np.deg2rad(dec))
+        minDot = np.cos(np.deg2rad(radius))
+        tables = []
+        for shardId in self.overlapping(ra, dec, radius):
+            data = self.readShard(shardId)
+            inside = unitVector(data["coord_ra"], data["coord_dec"]).dot(center) >= minDot
+            tables.append(data[inside])
+        if not tables:
+            dtype = makeDtype(next(iter(self.shards.values()))["dtype"]) if self.shards else np.dtype([])
+            return np.empty(0, dtype=dtype.newbyteorder("="))
+        table = np.concatenate(tables)
+        return table.astype(table.dtype.newbyteorder("="))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the shard index of an HTM-indexed reference "
+                                     "catalog, and optionally time a cone query.")
+    parser.add_argument('refCatDir', help="Directory of the reference catalog.")
+    parser.add_argument('--rebuild', action='store_true', help="Rebuild the index from scratch.")
+    parser.add_argument('--cone', nargs=3, type=float, metavar=('RA', 'DEC', 'RADIUS'),
+                        help="Cone to query, in degrees.")
+    args = parser.parse_args()
+
+    if args.rebuild and os.path.exists(os.path.join(args.refCatDir, INDEX_FILE)):
+        os.remove(os.path.join(args.refCatDir, INDEX_FILE))
+    start = time.time()
+    index = ShardIndex(args.refCatDir)
+    print("Indexed %d shards with %d rows in %.3f s." %
+          (len(index.shards), sum(entry["rows"] for entry in index.shards.values()), time.time() - start))
+    if args.cone:
+        start = time.time()
+        rows = index.coneSearch(*args.cone)
+        print("Found %d rows in %d shards in %.3f s." %
+              (len(rows), len(index.overlapping(*args.cone)), time.time() - start))
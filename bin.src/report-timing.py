@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""Report where processCcd spent its time in the demo.
+
+The timing of every subtask method is read from the processCcd metadata of
+each dataId, and printed as a table with one column per dataId, sorted by
+total CPU time.  The dataIds are listed from the registry of the input
+repository (see dataids.py), and may be selected with "--id" patterns.
+Optionally, the cProfile outputs written by ``processCcd.py --profile`` are
+combined and their most expensive functions printed.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import glob
+import os
+import pstats
+import re
+
+import lsst.daf.persistence as dafPersist
+
+import dataids
+
+
+def getTimings(metadata):
+    """Return a dict of the CPU time in seconds spent in each task method.
+
+    The keys are "<task>.<method>", where <task> is the full name of the
+    (sub)task, as recorded by `lsst.pipe.base.timeMethod` in the metadata.
+    """
+    timings = {}
+    for taskName in metadata.names(True):
+        taskMetadata = metadata.get(taskName)
+        if not hasattr(taskMetadata, "names"):
+            continue
+        for name in taskMetadata.names(True):
+            match = re.match(r"^(\w+)StartCpuTime$", name)
+            if not match or not taskMetadata.exists(match.group(1) + "EndCpuTime"):
+                continue
+            method = match.group(1)
+            starts = taskMetadata.getArray(method + "StartCpuTime")
+            ends = taskMetadata.getArray(method + "EndCpuTime")
+            timings["%s.%s" % (taskName.replace(":", "."), method)] = \
+                sum(end - start for start, end in zip(starts, ends))
+    return timings
+
+
+def printTimings(repo, inputRepo=None, patterns=None):
+    """Print the table of CPU time per task method and dataId of ``repo``.
+
+    The dataIds are those of the registry of ``inputRepo`` (by default, the
+    input repository of ``repo``) matching any of ``patterns`` (all if None)
+    which have processCcd metadata in ``repo``.
+    """
+    butler = dafPersist.Butler(repo)
+    if inputRepo is None:
+        index = dataids.DataIdIndex.fromOutputRepo(butler, repo)
+    else:
+        index = dataids.DataIdIndex(inputRepo)
+    index.addDatasets(butler, repo, ["processCcd_metadata"])
+    columns = []
+    timings = {}
+    for dataId in index.select(patterns, "processCcd_metadata"):
+        column = "%(run)d-%(filter)s-%(camcol)d-%(field)d" % dataId
+        columns.append(column)
+        for name, seconds in getTimings(butler.get("processCcd_metadata", dataId)).items():
+            timings.setdefault(name, {})[column] = seconds
+    if not columns:
+        print("No processCcd metadata found in %s." % (repo,))
+        return
+
+    width = max([len(name) for name in timings] + [len("Task method")])
+    cellWidth = max(len(c) for c in columns)
+    print("CPU time (seconds) per task method and run-filter-camcol-field:")
+    header = ["%-*s" % (width, "Task method")] + ["%*s" % (cellWidth, c) for c in columns]
+    print(" ".join(header + ["%9s" % "Total"]))
+    for name in sorted(timings, key=lambda n: -sum(timings[n].values())):
+        cells = ["%*.2f" % (cellWidth, timings[name][c]) if c in timings[name] else "%*s" % (cellWidth, "-")
+                 for c in columns]
+        print(" ".join(["%-*s" % (width, name)] + cells + ["%9.2f" % sum(timings[name].values())]))
+
+
+def printProfiles(profileDir, top):
+    """Print the ``top`` most expensive functions of all profiles in ``profileDir``."""
+    profiles = sorted(glob.glob(os.path.join(profileDir, "*.prof")))
+    if not profiles:
+        print("No profiles found in %s." % (profileDir,))
+        return
+    stats = pstats.Stats(profiles[0])
+    for profile in profiles[1:]:
+        stats.add(profile)
+    print()
+    print("Most expensive functions over %d profiles:" % len(profiles))
+    stats.sort_stats("cumulative").print_stats(top)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report where processCcd spent its time.")
+    parser.add_argument('repo', help="Output repository of processCcd.")
+    parser.add_argument('--input', help="Input repository, whose registry lists the dataIds (default: "
+                        "the input repository of repo).")
+    parser.add_argument('--id', action='append', dest='patterns', metavar='PATTERN',
+                        help='Only report the dataIds matching a pattern, e.g. "run=4192 filter=g^r"; may be '
+                        'given several times (default: all dataIds).')
+    parser.add_argument('--profiles', help="Directory of cProfile outputs of processCcd.py --profile.")
+    parser.add_argument('--top', type=int, default=30,
+                        help="Number of functions of the profiles to print (default: %(default)s).")
+    args = parser.parse_args()
+    dataids.checkPatterns(parser, args.patterns)
+
+    printTimings(args.repo, args.input, args.patterns)
+    if args.profiles:
+        printProfiles(args.profiles, args.top)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""Stage decompressed copies of the raw frames of an input repository.
+
+The corrected frames (fpC) of the SDSS input repository are gzipped, so
+every processCcd run inflates them again, one at a time.  This decompresses
+them once, in parallel, into a staging repository whose ``_parent`` is the
+input repository: the butler finds the staged frames first, and everything
+else (registry, calibrations, reference catalog) in the parent.
+
+A staged frame keeps the name of its source, which cfitsio reads as plain
+FITS since it is not gzipped, and is also available without the ``.gz``
+extension.  A manifest records the size, modification time and SHA-1 digest
+of each source and the digest of its staged copy, so that frames are only
+staged again when their source has changed; with ``--verify``, the staged
+copies are checked against their digests too.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+# Patterns of the compressed frames of the input repository, relative to it.
+PATTERNS = ("*/*/corr/*/fpC-*.fit.gz",)
+
+# Name of the manifest in the staging repository.
+MANIFEST = "staged.json"
+
+
+def fileDigest(filename, blockSize=1 << 20):
+    """Return the SHA-1 hex digest of the contents of ``filename``."""
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blockSize), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def stageFrame(args):
+    """Decompress a frame into the staging repository.
+
+    @param args  Tuple of (inputDir, stageDir, path), where ``path`` is the
+                 path of the frame relative to the repositories.
+
+    Return ``path`` and its manifest entry.
+    """
+    inputDir, stageDir, path = args
+    source = os.path.join(inputDir, path)
+    target = os.path.join(stageDir, path)
+    if not os.path.isdir(os.path.dirname(target)):
+        try:
+            os.makedirs(os.path.dirname(target))
+        except OSError:
+            # created by another worker in the meantime
+            pass
+    stat = os.stat(source)
+    sha = hashlib.sha1()
+    tmp = target + ".tmp"
+    with gzip.open(source, "rb") as f, open(tmp, "wb") as out:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+            out.write(block)
+    os.rename(tmp, target)
+    # the frame without the .gz extension, for mappers which look for it
+    link = target[:-len(".gz")]
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(target), link)
+    return path, dict(size=stat.st_size, mtime=stat.st_mtime, source=fileDigest(source),
+                      digest=sha.hexdigest())
+
+
+def isStaged(inputDir, stageDir, path, entry, verify):
+    """Return whether the staged copy of ``path`` described by ``entry`` is up to date.
+
+    The source is only hashed again if its size or modification time have
+    changed, in which case ``entry`` is updated.
+    """
+    if entry is None or not os.path.exists(os.path.join(stageDir, path)):
+        return False
+    source = os.path.join(inputDir, path)
+    stat = os.stat(source)
+    if entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+        if fileDigest(source) != entry["source"]:
+            return False
+        entry.update(size=stat.st_size, mtime=stat.st_mtime)
+    return not verify or fileDigest(os.path.join(stageDir, path)) == entry["digest"]
+
+
+def main(inputDir, stageDir, jobs=None, verify=False):
+    """Stage the compressed frames of ``inputDir`` in ``stageDir``, with ``jobs`` processes.
+
+    By default, one process per CPU is used.
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if not os.path.isdir(stageDir):
+        os.makedirs(stageDir)
+    parent = os.path.join(stageDir, "_parent")
+    if not os.path.lexists(parent):
+        os.symlink(os.path.relpath(inputDir, stageDir), parent)
+    shutil.copy(os.path.join(inputDir, "_mapper"), stageDir)
+
+    manifestFile = os.path.join(stageDir, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifestFile):
+        with open(manifestFile) as f:
+            manifest = json.load(f)
+
+    paths = sorted(os.path.relpath(source, inputDir) for pattern in PATTERNS
+                   for source in glob.glob(os.path.join(inputDir, pattern)))
+    for path in set(manifest) - set(paths):
+        # the source is gone
+        for staged in (path, path[:-len(".gz")]):
+            if os.path.lexists(os.path.join(stageDir, staged)):
+                os.remove(os.path.join(stageDir, staged))
+        del manifest[path]
+    tasks = [(inputDir, stageDir, path) for path in paths
+             if not isStaged(inputDir, stageDir, path, manifest.get(path), verify)]
+
+    start = time.time()
+    pool = multiprocessing.Pool(jobs) if jobs > 1 and len(tasks) > 1 else None
+    try:
+        for i, (path, entry) in enumerate((pool.imap_unordered if pool else map)(stageFrame, tasks)):
+            manifest[path] = entry
+            print("\rStaged %d/%d frames" % (i + 1, len(tasks)), end="", file=sys.stderr)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        with open(manifestFile + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(manifestFile + ".tmp", manifestFile)
+    if tasks:
+        print(file=sys.stderr)
+    print("Staged %d of %d frames in %.2f s with %d jobs; %d were up to date." %
+          (len(tasks), len(paths), time.time() - start, jobs, len(paths) - len(tasks)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stage decompressed copies of the raw frames of an input "
+                                     "repository.")
+    parser.add_argument('input', help="Input repository.")
+    parser.add_argument('stage', help="Staging repository, whose parent is the input repository.")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="Number of frames decompressed concurrently (default: the number of CPUs).")
+    parser.add_argument('--verify', action='store_true',
+                        help="Check the staged copies against their digests, and stage them again if they "
+                        "differ.")
+    args = parser.parse_args()
+
+    main(args.input, args.stage, jobs=args.jobs, verify=args.verify)
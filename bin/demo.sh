@@ -12,8 +12,14 @@ source "$EUPS_DIR/bin/setups.sh"
 
 SIZE=""
 SIZE_EXT=""
-FILTER_SET_4192="u^g^r^i^z"
-FILTER_SET_6377="u^g^r^i^z"
+# Patterns of the dataIds to process, in the syntax of --id of processCcd.py;
+# the dataIds are looked up in the registry of the input repository.
+DATAID_PATTERNS=("run=4192 camcol=4 field=300" "run=6377 camcol=4 field=399")
+JOBS=""
+PROFILE=""
+INCREMENTAL=""
+STAGE=""
+INPUT=input
 
 #--------------------------------------------------------------------------
 usage() {
@@ -21,22 +27,42 @@ usage() {
     echo "Run demonstration run."
     echo
     echo "Options:"
-    echo "  --small : to use a small dataset; otherwise a mini-production size will be used."
-    echo "   --help : print this message."
-    echo "       -- : an unadorned '--' stops argument processing at that point."
+    echo "   --small : to use a small dataset; otherwise a mini-production size will be used."
+    echo "  --jobs N : process each dataId separately, running up to N at a time, with one"
+    echo "             log file per dataId and a timing summary at the end."
+    echo " --profile : process each dataId separately (with --jobs 1 unless given) with"
+    echo "             cProfile, saving the profiles and a table of the CPU time of each"
+    echo "             subtask in the output directory."
+    echo "    --incremental : keep the output directory, and only process (one at a time"
+    echo "             unless --jobs is given) and export the dataIds whose inputs,"
+    echo "             config or stack have changed since they were last processed."
+    echo "   --stage : decompress the raw frames once, in parallel (one process per CPU"
+    echo "             unless --jobs is given), into the staging repository"
+    echo "             'staged-input', and process from there."
+    echo "    --help : print this message."
+    echo "        -- : an unadorned '--' stops argument processing at that point."
     exit
 }
 #--------------------------------------------------------------------------
 
-options=(getopt --long small,help -- "$@")
+options=(getopt --long small,jobs:,profile,incremental,stage,help -- "$@")
 while true
 do
     case "$1" in
         --small)   SIZE='small';
                    SIZE_EXT="_small";
-                   FILTER_SET_4192="g^i^z";
-                   FILTER_SET_6377="u^r^i";
-                   shift 1 ; break ;;
+                   DATAID_PATTERNS=("run=4192 camcol=4 field=300 filter=g^i^z"
+                                    "run=6377 camcol=4 field=399 filter=u^r^i");
+                   shift 1 ;;
+        --jobs)    [[ "$2" =~ ^[1-9][0-9]*$ ]] || usage;
+                   JOBS="$2";
+                   shift 2 ;;
+        --profile) PROFILE=1;
+                   shift 1 ;;
+        --incremental) INCREMENTAL=1;
+                   shift 1 ;;
+        --stage)   STAGE=1;
+                   shift 1 ;;
         --help)    usage;;
         --)        shift ; break ;;
         *)         [ "$*" != "" ] && usage;
@@ -51,19 +77,171 @@ test -d input || { echo "Could not find the 'input' directory. Run this script f
 set -e
 
 
-rm -rf output detected-sources.txt output_small detected-sources_small.txt
 # Reconfigure to use the included reference catalog
 CONFIG=config/processCcd.py
+OUTPUT=output$SIZE_EXT
+if [[ -z "$INCREMENTAL" ]]; then
+    rm -rf output detected-sources.txt output_small detected-sources_small.txt
+else
+    rm -f detected-sources$SIZE_EXT.txt
+fi
+
+#--------------------------------------------------------------------------
+# Process a single dataId, given as a space separated "key=value" list,
+# logging to $LOGDIR/<dataId>.log and recording "<status> <seconds> <dataId>"
+# in $LOGDIR/<dataId>.status.  If $PROFILEDIR is set, the cProfile output is
+# written to $PROFILEDIR/<dataId>.prof.  If $FINGERPRINTDIR is set, the
+# pending fingerprint $FINGERPRINTDIR/<dataId>.new of the dataId is recorded
+# as $FINGERPRINTDIR/<dataId> once it has been processed successfully; as the
+# config or the stack may have changed since the output repository was
+# written, processCcd then replaces the config and package versions it saved
+# there (without backups, which concurrent runs would race to write).
+run_dataid() {
+    local dataid="$1"
+    local name
+    name=$(dataid_name "$dataid")
+    # DYLD_LIBRARY_PATH is stripped when bash is re-executed on OS X.
+    if [[ $(uname -s) = Darwin* ]]; then
+        if [[ -z "$DYLD_LIBRARY_PATH" ]]; then
+            export DYLD_LIBRARY_PATH=$LSST_LIBRARY_PATH
+        fi
+    fi
+    local options=()
+    if [[ -n "$PROFILEDIR" ]]; then
+        options+=(--profile "$PROFILEDIR/$name.prof")
+    fi
+    if [[ -n "$FINGERPRINTDIR" ]]; then
+        options+=(--clobber-config --clobber-versions --no-backup-config)
+    fi
+    # The time keyword reports the wall clock time with millisecond
+    # resolution; the command substitution runs in a subshell, so the exit
+    # status is passed back through a file.
+    local TIMEFORMAT=%R
+    local seconds
+    local status=0
+    rm -f "$LOGDIR/$name.exit"
+    seconds=$( { time processCcd.py "$INPUT" --id $dataid --output "$OUTPUT" --configfile="$CONFIG" \
+        "${options[@]}" > "$LOGDIR/$name.log" 2>&1 || echo $? > "$LOGDIR/$name.exit"; } 2>&1 )
+    if [[ -f "$LOGDIR/$name.exit" ]]; then
+        status=$(cat "$LOGDIR/$name.exit")
+        rm -f "$LOGDIR/$name.exit"
+    fi
+    echo "$status $seconds $dataid" > "$LOGDIR/$name.status"
+    if [[ $status -ne 0 ]]; then
+        echo "Processing of $dataid failed; see $LOGDIR/$name.log" >&2
+    elif [[ -n "$FINGERPRINTDIR" && -f "$FINGERPRINTDIR/$name.new" ]]; then
+        mv "$FINGERPRINTDIR/$name.new" "$FINGERPRINTDIR/$name"
+    fi
+    return $status
+}
+
+# Name of a dataId in file names, e.g. "4192-g-4-300".
+dataid_name() {
+    echo "$1" | sed -e 's/[a-z]*=//g' -e 's/ /-/g'
+}
+#--------------------------------------------------------------------------
+
 # The following config overrides are necessary for the demo to run, until new 'truth' values are computed
 # based on the new stack default of growing footprints and running the deblender. See issue 4801
-processCcd.py input --id run=4192 filter=$FILTER_SET_4192 camcol=4 field=300 --id run=6377 filter=$FILTER_SET_6377 camcol=4 field=399 --output output$SIZE_EXT --configfile=$CONFIG
+if [[ -n "$STAGE" ]]; then
+    # The staged frames are kept across runs, and only staged again when
+    # their source changes.  They are decompressed by one process per CPU,
+    # unless --jobs is given.
+    python ./bin.src/stage-inputs.py input staged-input ${JOBS:+--jobs "$JOBS"}
+    INPUT=staged-input
+fi
+if [[ -n "$PROFILE" ]]; then
+    JOBS=${JOBS:-1}
+    PROFILEDIR=$OUTPUT/profiles
+fi
+if [[ -n "$INCREMENTAL" ]]; then
+    JOBS=${JOBS:-1}
+    FINGERPRINTDIR=$OUTPUT/fingerprints
+fi
+ID_ARGS=()
+for pattern in "${DATAID_PATTERNS[@]}"; do
+    ID_ARGS+=(--id "$pattern")
+done
+DATAIDS=()
+while read -r dataid; do
+    DATAIDS+=("$dataid")
+done < <(python ./bin.src/dataids.py input "${ID_ARGS[@]}")
+if [[ ${#DATAIDS[@]} -eq 0 ]]; then
+    echo "No dataId of the input registry matches ${DATAID_PATTERNS[*]}." >&2
+    exit 1
+fi
+if [[ -z "$JOBS" ]]; then
+    PROCESS_ARGS=()
+    for dataid in "${DATAIDS[@]}"; do
+        PROCESS_ARGS+=(--id $dataid)
+    done
+    processCcd.py "$INPUT" "${PROCESS_ARGS[@]}" --output $OUTPUT --configfile=$CONFIG
+else
+    # Create the output repository up front, so that the concurrent
+    # processCcd.py invocations do not race to create it.
+    python -c "import lsst.daf.persistence as dafPersist; dafPersist.Butler(inputs='$INPUT', outputs='$OUTPUT')"
+    LOGDIR=$OUTPUT/logs
+    mkdir -p "$LOGDIR"
+    rm -f "$LOGDIR"/*.status
+    if [[ -n "$PROFILEDIR" ]]; then
+        mkdir -p "$PROFILEDIR"
+    fi
+
+    if [[ -n "$FINGERPRINTDIR" ]]; then
+        # Only keep the dataIds whose fingerprint differs from the one
+        # recorded when they were last processed successfully.
+        mkdir -p "$FINGERPRINTDIR"
+        FINGERPRINTS=$(python ./bin.src/fingerprint-inputs.py input $CONFIG "${DATAIDS[@]}")
+        DATAIDS=()
+        while read -r fingerprint dataid; do
+            name=$(dataid_name "$dataid")
+            if [[ "$(cat "$FINGERPRINTDIR/$name" 2>/dev/null)" != "$fingerprint" ]]; then
+                echo "$fingerprint" > "$FINGERPRINTDIR/$name.new"
+                DATAIDS+=("$dataid")
+            fi
+        done <<< "$FINGERPRINTS"
+    fi
+
+    export -f run_dataid dataid_name
+    export INPUT OUTPUT CONFIG LOGDIR PROFILEDIR FINGERPRINTDIR
+    if [[ ${#DATAIDS[@]} -eq 0 ]]; then
+        echo "All dataIds are up to date."
+    else
+        echo "Processing ${#DATAIDS[@]} dataIds with up to $JOBS jobs; logs are in $LOGDIR."
+        FAILED=0
+        printf '%s\n' "${DATAIDS[@]}" | xargs -P "$JOBS" -I{} bash -c 'run_dataid "$1"' _ {} || FAILED=1
+
+        echo
+        echo "Processing time per dataId (seconds):"
+        sort -k2,2nr "$LOGDIR"/*.status | while read -r status seconds dataid; do
+            if [[ $status -eq 0 ]]; then
+                printf "%8.2f  %s\n" "$seconds" "$dataid"
+            else
+                printf "%8.2f  %s  (FAILED, status %d)\n" "$seconds" "$dataid" "$status"
+            fi
+        done
+        if [[ $FAILED -ne 0 ]]; then
+            echo "Processing failed for at least one dataId." >&2
+            exit 1
+        fi
+    fi
+fi
 
 # We need to explicitly run Python here as the command to allow
 #   the library load path environment to be passed to export-results
 #   on modern OS X versions.
 # The `#!/usr/bin/env python` in the first line of export-results
 #   no longer loads the correct environment.
-python ./bin.src/export-results.py output$SIZE_EXT > detected-sources$SIZE_EXT.txt
+if [[ -n "$INCREMENTAL" ]]; then
+    python ./bin.src/export-results.py $OUTPUT "${ID_ARGS[@]}" --cache-dir $OUTPUT/export-cache --jobs "$JOBS" > detected-sources$SIZE_EXT.txt
+else
+    python ./bin.src/export-results.py $OUTPUT "${ID_ARGS[@]}" > detected-sources$SIZE_EXT.txt
+fi
+
+if [[ -n "$PROFILE" ]]; then
+    echo
+    python ./bin.src/report-timing.py $OUTPUT "${ID_ARGS[@]}" --profiles "$PROFILEDIR" | tee "$OUTPUT/timing.txt"
+fi
 
 echo
 echo "Processing completed successfully. The results are in detected-sources$SIZE_EXT.txt."
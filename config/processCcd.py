@@ -1,8 +1,15 @@
+# The Gen2 loaders share an in-process cache of the reference catalog shards
+# (see python/lsst/dm_stack_demo/refcatLoader.py), so that the shards of a
+# field are only read once for all loaders and filters processed by one
+# processCcd.py.
+from lsst.dm_stack_demo.refcatLoader import CachedLoadIndexedReferenceObjectsTask
+
 # This sets the reference catalog name for Gen2.
 for refObjLoader in (config.calibrate.astromRefObjLoader,
                      config.calibrate.photoRefObjLoader,
                      config.charImage.refObjLoader,
                      ):
+    refObjLoader.retarget(CachedLoadIndexedReferenceObjectsTask)
     refObjLoader.ref_dataset_name = "sdss_demo_ref_cat"
 
 # This sets up the reference catalog for Gen3.
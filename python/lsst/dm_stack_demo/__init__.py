@@ -0,0 +1 @@
+from .refcatLoader import *  # noqa: F401,F403
@@ -0,0 +1,150 @@
+"""A reference object loader which caches the shards it reads.
+
+processCcd has three reference object loaders (``charImage.refObjLoader``,
+``calibrate.astromRefObjLoader`` and ``calibrate.photoRefObjLoader``), which
+all read the same shards of the reference catalog for each CCD, and the
+five filters of an SDSS field cover the same sky.  The loader here keeps the
+shards it reads in a least recently used cache, which is shared by all
+loaders of the process, so that each shard is only read and decoded once
+while it stays in the cache.  The cache only lives as long as the process:
+when each dataId is processed by a processCcd.py of its own, only the
+loaders of that dataId share it.
+
+config/processCcd.py retargets the loaders to
+`CachedLoadIndexedReferenceObjectsTask`; the size of the cache is bounded by
+its ``cacheMaxRows`` and ``cacheMaxBytes`` config fields.
+"""
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+
+import lsst.pex.config as pexConfig
+from lsst.meas.algorithms import LoadIndexedReferenceObjectsConfig, LoadIndexedReferenceObjectsTask
+
+__all__ = ["ShardCache", "CachedLoadIndexedReferenceObjectsConfig", "CachedLoadIndexedReferenceObjectsTask"]
+
+
+class ShardCache(object):
+    """Least recently used cache of reference catalog shards.
+
+    Each entry is the list of catalogs returned by the base loader for one
+    shard of one catalog (empty or None for missing shards).
+
+    @param maxRows   Maximum total number of rows of the cached shards.
+    @param maxBytes  Maximum total size in bytes of the records of the cached
+                     shards.
+
+    A limit of 0 disables the cache.
+    """
+
+    def __init__(self, maxRows=0, maxBytes=0):
+        self.maxRows = maxRows
+        self.maxBytes = maxBytes
+        self.shards = OrderedDict()
+        self.rows = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def size(shards):
+        """Return the number of rows and bytes of the catalogs ``shards``."""
+        shards = [shard for shard in shards if shard is not None]
+        return (sum(len(shard) for shard in shards),
+                sum(len(shard)*shard.getSchema().getRecordSize() for shard in shards))
+
+    def get(self, key, load):
+        """Return the entry ``key``, calling ``load()`` to read it if it is not cached."""
+        if key in self.shards:
+            self.hits += 1
+            shards = self.shards.pop(key)
+            self.shards[key] = shards
+            return shards
+        self.misses += 1
+        shards = load()
+        rows, nBytes = self.size(shards)
+        if rows > self.maxRows or nBytes > self.maxBytes:
+            return shards
+        self.shards[key] = shards
+        self.rows += rows
+        self.bytes += nBytes
+        while self.rows > self.maxRows or self.bytes > self.maxBytes:
+            rows, nBytes = self.size(self.shards.popitem(last=False)[1])
+            self.rows -= rows
+            self.bytes -= nBytes
+        return shards
+
+    def setLimits(self, maxRows, maxBytes):
+        """Change the limits of the cache, evicting shards as needed."""
+        self.maxRows = maxRows
+        self.maxBytes = maxBytes
+        while self.shards and (self.rows > self.maxRows or self.bytes > self.maxBytes):
+            rows, nBytes = self.size(self.shards.popitem(last=False)[1])
+            self.rows -= rows
+            self.bytes -= nBytes
+
+
+# Cache of the shards read by all loaders of the process.
+_cache = ShardCache()
+
+
+class CachedLoadIndexedReferenceObjectsConfig(LoadIndexedReferenceObjectsConfig):
+    cacheMaxRows = pexConfig.Field(
+        dtype=int,
+        default=10000000,
+        doc="Maximum total number of rows of the reference catalog shards cached in memory, "
+            "shared by all loaders of the process (0 to disable the cache).",
+    )
+    cacheMaxBytes = pexConfig.Field(
+        dtype=int,
+        default=1 << 30,
+        doc="Maximum total size in bytes of the reference catalog shards cached in memory, "
+            "shared by all loaders of the process (0 to disable the cache).",
+    )
+
+
+class CachedLoadIndexedReferenceObjectsTask(LoadIndexedReferenceObjectsTask):
+    """Load reference objects from an indexed catalog, caching the shards read.
+
+    The cache is shared by all instances of the task in the process, and
+    keyed by the location of the catalog, so that loaders of different
+    repositories or catalogs never share shards.  Shards are returned as
+    deep copies, so that the cached shards are never modified by their
+    users.
+    """
+    ConfigClass = CachedLoadIndexedReferenceObjectsConfig
+
+    def getCatalogLocation(self):
+        """Return the location of the catalog in the butler's repositories.
+
+        This is the URI of the config of the catalog, which is found in the
+        same repository as its shards.
+        """
+        if getattr(self, "_catalogLocation", None) is None:
+            self._catalogLocation = self.butler.getUri("ref_cat_config", name=self.ref_dataset_name)
+        return self._catalogLocation
+
+    def getShards(self, shardIdList):
+        """Get the shards ``shardIdList``, from the cache where possible.
+
+        Return the same list as the base task.
+        """
+        _cache.setLimits(self.config.cacheMaxRows, self.config.cacheMaxBytes)
+        hits = _cache.hits
+        location = self.getCatalogLocation()
+        shards = []
+        for shardId in shardIdList:
+            cached = _cache.get((location, shardId), lambda: _readShards(self, [shardId]))
+            shards.extend(shard.copy(deep=True) if shard is not None else None for shard in cached)
+        self.log.debug("Read %d of %d reference catalog shards from the cache",
+                       _cache.hits - hits, len(shardIdList))
+        return shards
+
+    # Older versions of the base task call the method by this name.
+    get_shards = getShards
+
+
+# The method of the base task which reads shards with the butler.
+_readShards = getattr(LoadIndexedReferenceObjectsTask, "getShards", None) or \
+    LoadIndexedReferenceObjectsTask.get_shards
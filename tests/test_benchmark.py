@@ -0,0 +1,71 @@
+#
+# LSST Data Management System
+# Copyright 2012-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# benchmark.py only runs other scripts, so it is tested without the stack.
+package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(package_root, 'bin.src'))
+
+import benchmark  # noqa: E402
+
+
+class RunStageTestCase(unittest.TestCase):
+    """Test the measurements of each stage run by benchmark.py."""
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.stdout = os.path.join(self.tmpDir, "stage.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testPeakPerStage(self):
+        """Test that a small stage run after a large one keeps its own peak RSS"""
+        # touch every page of 300 MB, so that it is resident
+        allocate = "b = bytearray(300 << 20); b[::4096] = b'x'*len(b[::4096])"
+        large = benchmark.runStage([sys.executable, "-c", allocate], self.stdout)
+        small = benchmark.runStage([sys.executable, "-c", "pass"], self.stdout)
+        self.assertEqual((large[0], small[0]), (0, 0))
+        self.assertGreater(large[3], 300)
+        self.assertLess(small[3], 200)
+
+    def testStatus(self):
+        """Test the exit status and output of a failing stage"""
+        status, elapsed, cpu, rss = benchmark.runStage(
+            [sys.executable, "-c", "import sys; print('partial'); sys.exit(3)"], self.stdout)
+        self.assertEqual(status, 3)
+        self.assertGreaterEqual(elapsed, 0)
+        self.assertGreaterEqual(cpu, 0)
+        with open(self.stdout) as f:
+            self.assertEqual(f.read(), "partial\n")
+        status = benchmark.runStage([sys.executable, "-c", "import os; os.kill(os.getpid(), 9)"],
+                                    self.stdout)[0]
+        self.assertEqual(status, -1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+#
+# LSST Data Management System
+# Copyright 2012-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+
+# The plots of check_astrometry.py only need NumPy and matplotlib, so they
+# are tested without the stack.
+package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(package_root, 'bin.src'))
+
+import check_astrometry  # noqa: E402
+
+try:
+    import matplotlib
+except ImportError:
+    matplotlib = None
+
+
+@unittest.skipUnless(matplotlib, "matplotlib is needed to plot")
+class PlotTestCase(unittest.TestCase):
+    """Test the astrometry plots of check_astrometry.py."""
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testNonFiniteMagnitude(self):
+        """Test that a NaN magnitude does not empty the density maps"""
+        rng = np.random.RandomState(1)
+        n = 30000
+        mag = rng.uniform(15, 20, n)
+        dist = rng.uniform(0, 150, n)
+        mag[10] = np.nan
+        mag[20] = np.inf
+        plotPath = os.path.join(self.tmpDir, "astrometry.png")
+        dataPath = os.path.join(self.tmpDir, "astrometry.npz")
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", RuntimeWarning)
+            fig = check_astrometry.plotAstrometry(mag, dist, n, plotPath=plotPath, maxPoints=20000,
+                                                  dataPath=dataPath)
+        self.assertTrue(os.path.exists(plotPath))
+        finite = np.isfinite(mag).sum()
+        good = (mag < 19.5).sum()
+        self.assertGreater(good, 20000)
+        # every magnitude panel (the right-hand column) is a density map of all the stars shown
+        for axMag, expected in zip(fig.axes[1::2], [finite, finite, good]):
+            self.assertEqual(axMag.collections[0].get_array().sum(), expected)
+        data = np.load(dataPath)
+        self.assertEqual(data["counts0"].sum(), n)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,257 @@
+#
+# LSST Data Management System
+# Copyright 2012-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+# compare.py only needs NumPy, so it is tested without the stack.
+package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(package_root, 'bin.src'))
+
+import compare  # noqa: E402
+
+
+def makeTable(n, seed=1):
+    """Return a table of ``n`` sources with an id, a float and a flag column."""
+    rng = np.random.RandomState(seed)
+    table = np.empty(n, dtype=[("id", np.int64), ("coord_ra", float), ("coord_dec", float),
+                               ("flag", bool)])
+    table["id"] = np.arange(n) + 1000
+    table["coord_ra"] = rng.uniform(10, 10.1, n)
+    table["coord_dec"] = rng.uniform(-0.05, 0.05, n)
+    table["flag"] = rng.uniform(size=n) > 0.5
+    return table
+
+
+class StreamingTestCase(unittest.TestCase):
+    """Test the block-wise comparison of compare.py."""
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testIterAligned(self):
+        """Test the pairing of blocks split at different rows"""
+        values = np.arange(23)
+        blocks1 = [values[i:i + 5] for i in range(0, 23, 5)]
+        blocks2 = [values[i:i + 7] for i in range(0, 23, 7)]
+        pairs = list(compare.iter_aligned(blocks1, blocks2))
+        for block1, block2 in pairs:
+            np.testing.assert_array_equal(block1, block2)
+        np.testing.assert_array_equal(np.concatenate([b for b, _ in pairs]), values)
+
+    def testIterAlignedUneven(self):
+        """Test that the rows left over in one iterator are paired with None"""
+        values = np.arange(10)
+        pairs = list(compare.iter_aligned([values[:4], values[4:10]], [values[:3], values[3:6]]))
+        self.assertEqual(sum(len(b1) for b1, b2 in pairs if b2 is not None), 6)
+        left = [b1 for b1, b2 in pairs if b2 is None]
+        np.testing.assert_array_equal(np.concatenate(left), values[6:])
+        self.assertEqual(list(compare.iter_aligned([values], [])), [(values, None)])
+
+    def testDifferenceBuffers(self):
+        """Test that differences computed in buffers match the allocating version"""
+        arr1 = np.array([1.0, 0.0, np.nan, np.nan, 2.0, -3.0])
+        arr2 = np.array([1.0, 1e-20, np.nan, 1.0, 2.5, -3.0])
+        absDiff, relDiff = compare.difference(arr1, arr2)
+        buffers = compare.DifferenceBuffers(10)
+        absBuf, relBuf = compare.difference(arr1, arr2, out=buffers)
+        np.testing.assert_array_equal(absBuf, absDiff)
+        np.testing.assert_array_equal(relBuf, relDiff)
+        np.testing.assert_array_equal(absDiff, [0, np.inf, 0, np.inf, 0.5, 0])
+        self.assertEqual(relDiff[4], 0.25)
+
+    def testColumnSummary(self):
+        """Test the counts and rows kept by ColumnSummary over several blocks"""
+        column = compare.ColumnSummary("x", True, 2)
+        column.add(np.array([1, 4]), np.array([1., 2.]), np.array([1.1, 3.]), np.array([0.1, 1.]),
+                   np.array([0.1, 0.5]))
+        column.add(np.array([], dtype=int), np.array([]), np.array([]), np.array([]), np.array([]))
+        column.add(np.array([7]), np.array([5.]), np.array([9.]), np.array([4.]), np.array([0.8]))
+        self.assertEqual(column.nFailed, 3)
+        self.assertEqual(column.maxAbsDiff, 4.)
+        self.assertEqual(column.maxRelDiff, 0.8)
+        self.assertEqual(list(column.rows), [7, 4])
+
+        flags = compare.ColumnSummary("flag", False, 1)
+        flags.add(np.array([2, 3]), np.array(["True", "True"]), np.array(["False", "False"]))
+        self.assertEqual((flags.nFailed, list(flags.rows)), (2, [2]))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            flags.report(10, 0.)
+            compare.ColumnSummary("id", False, 0, isFlag=False).report(10, 0.)
+        self.assertIn("2 of 10 flags do not match", output.getvalue())
+        self.assertIn("0 of 10 values do not match", output.getvalue())
+
+    def testStreaming(self):
+        """Test that streaming with uneven blocks finds the same failures as a full comparison"""
+        table = makeTable(50)
+        reference = os.path.join(self.tmpDir, "reference.npy")
+        np.save(reference, table)
+        modified = table.copy()
+        modified["coord_ra"][[3, 31]] += 1e-3
+        modified["id"][17] = 1
+        filename = os.path.join(self.tmpDir, "modified.npy")
+        np.save(filename, modified)
+        for blockSize in (1, 7, 50, 64):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                self.assertTrue(compare.compareStreaming(reference, reference, 1e-10, blockSize))
+                self.assertFalse(compare.compareStreaming(filename, reference, 1e-10, blockSize, summary=5))
+            self.assertIn("2 of 50 values over tolerance", output.getvalue())
+            self.assertIn("1 of 50 values do not match) in column id", output.getvalue())
+
+    def testStreamingFailFast(self):
+        """Test that the counts of a comparison stopped early are reported as partial"""
+        table = makeTable(50)
+        reference = os.path.join(self.tmpDir, "reference.npy")
+        np.save(reference, table)
+        table["coord_ra"][[3, 31]] += 1e-3
+        filename = os.path.join(self.tmpDir, "modified.npy")
+        np.save(filename, table)
+        for summary in (0, 5):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                self.assertFalse(compare.compareStreaming(filename, reference, 1e-10, 7, failFast=True,
+                                                          summary=summary))
+            self.assertIn("1 of the first 7 values over tolerance", output.getvalue())
+            self.assertNotIn("of 50", output.getvalue())
+
+
+class AlignTestCase(unittest.TestCase):
+    """Test the alignment of the rows of the same sources."""
+    def setUp(self):
+        self.reference = makeTable(40)
+        rng = np.random.RandomState(2)
+        # permuted, with rows 5 and 12 of the reference missing, and an extra source
+        order = rng.permutation([i for i in range(40) if i not in (5, 12)])
+        extra = makeTable(1, seed=3)
+        extra["id"] = 99999
+        extra["coord_ra"] = 11.
+        self.table = np.concatenate([self.reference[order], extra])
+
+    def checkAligned(self, key):
+        rows1, rows2, extra, missing = compare.alignRows(self.table, self.reference, key)
+        np.testing.assert_array_equal(self.table[rows1], self.reference[rows2])
+        np.testing.assert_array_equal(rows2, np.sort(rows2))
+        self.assertEqual(list(missing), [5, 12])
+        self.assertEqual(list(extra), [len(self.table) - 1])
+
+    def testAlignId(self):
+        """Test aligning permuted rows on their ids"""
+        self.checkAligned("id")
+
+    def testAlignCoord(self):
+        """Test aligning permuted rows on their coordinates"""
+        self.checkAligned("coord")
+
+    def testDuplicateIds(self):
+        """Test that duplicate ids are refused"""
+        self.table["id"][1] = self.table["id"][0]
+        with self.assertRaises(ValueError):
+            compare.alignRows(self.table, self.reference, "id")
+
+    def testDuplicateCoords(self):
+        """Test that sources with the same coordinates are paired one to one, by id"""
+        reference = makeTable(4)
+        for name in ("coord_ra", "coord_dec"):
+            reference[name][1] = reference[name][0]
+        table = reference[[1, 3, 0, 2]]
+        rows1, rows2 = compare.matchCoords(table, reference, 1.0)
+        self.assertEqual(len(rows1), 4)
+        np.testing.assert_array_equal(table["id"][rows1], reference["id"][rows2])
+
+    def testCompareAligned(self):
+        """Test that compareWithNumPy reports the unmatched sources"""
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertFalse(compare.compareWithNumPy(self.table, self.reference, 1e-10, align="id"))
+            self.assertTrue(compare.compareWithNumPy(self.reference[::-1], self.reference, 1e-10, align="id"))
+            self.assertFalse(compare.compareWithNumPy(self.reference[::-1], self.reference, 1e-10))
+        self.assertIn("2 sources of the reference are missing from the input (ids 1005 1012)",
+                      output.getvalue())
+        self.assertIn("1 sources of the input are not in the reference (ids 99999)", output.getvalue())
+
+
+class BatchTestCase(unittest.TestCase):
+    """Test the batch mode of compare.py."""
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testReadManifest(self):
+        """Test parsing manifests with comments, blank lines and one or two columns"""
+        manifest = os.path.join(self.tmpDir, "pairs.txt")
+        with open(manifest, "w") as f:
+            f.write("# file reference\n\na.txt\n  b.npy  expected/b.txt  \n# c.txt\n")
+        self.assertEqual(compare.readManifest(manifest), [("a.txt", None), ("b.npy", "expected/b.txt")])
+        with open(manifest, "w") as f:
+            f.write("a.txt b.txt c.txt\n")
+        with self.assertRaises(ValueError):
+            compare.readManifest(manifest)
+
+    def testMissingReference(self):
+        """Test that a pair whose reference cannot be found reports the paths searched"""
+        filename = os.path.join(self.tmpDir, "no-such-reference.npy")
+        np.save(filename, makeTable(3))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertFalse(compare.compareBatch([(filename, None)], dict(tolerance=1e-10)))
+        self.assertIn("(no reference)", output.getvalue())
+        self.assertNotIn("None", output.getvalue())
+        self.assertIn("no-such-reference.txt", output.getvalue())
+
+    def testMalformedPair(self):
+        """Test that an error comparing one pair of a manifest only fails that pair"""
+        reference = os.path.join(self.tmpDir, "reference.npy")
+        np.save(reference, makeTable(3))
+        malformed = os.path.join(self.tmpDir, "malformed.npy")
+        # no columns, so aligning on ids raises an IndexError
+        np.save(malformed, np.arange(3.))
+        manifest = os.path.join(self.tmpDir, "pairs.txt")
+        with open(manifest, "w") as f:
+            f.write("%s %s\n%s %s\n" % (malformed, reference, reference, reference))
+        for jobs in (1, 2):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                self.assertFalse(compare.compareBatch(compare.readManifest(manifest),
+                                                      dict(tolerance=1e-10, align="id"), jobs=jobs))
+            lines = output.getvalue().splitlines()
+            self.assertTrue(lines[0].startswith("FAILED"))
+            self.assertIn("Error: IndexError", lines[1])
+            self.assertTrue(any(line.startswith("Ok") and "reference.npy (reference" in line
+                                for line in lines))
+            self.assertIn("1 of 2 comparisons failed", output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
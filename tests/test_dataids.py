@@ -0,0 +1,121 @@
+#
+# LSST Data Management System
+# Copyright 2012-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+# dataids.py only needs the butler to locate datasets, so it is tested
+# without the stack.
+package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(package_root, 'bin.src'))
+
+import dataids  # noqa: E402
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+def makeRegistry(repo, rows):
+    """Create the registry of the input repository ``repo``, listing the raw frames ``rows``."""
+    os.makedirs(repo)
+    connection = sqlite3.connect(os.path.join(repo, "registry.sqlite3"))
+    try:
+        connection.execute("CREATE TABLE raw (run INT, filter TEXT, camcol INT, field INT)")
+        connection.executemany("INSERT INTO raw VALUES (?, ?, ?, ?)", rows)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+class DataIdIndexTestCase(unittest.TestCase):
+    """Test the selection of dataIds from the registry of the input repository."""
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.input = os.path.join(self.tmpDir, "input")
+        makeRegistry(self.input, [(run, f, 4, field) for run, field in ((6377, 399), (4192, 300))
+                                  for f in "zugri"])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testSelect(self):
+        """Test the order of the dataIds, and their selection with patterns"""
+        index = dataids.DataIdIndex(self.input)
+        self.assertEqual([dataids.formatDataId(d) for d in index.select()[:3]],
+                         ["run=4192 filter=u camcol=4 field=300", "run=6377 filter=u camcol=4 field=399",
+                          "run=4192 filter=g camcol=4 field=300"])
+        selected = index.select(["run=4192 filter=g^i^z", "run=6377 field=300..399 filter=u*"])
+        self.assertEqual([(d["run"], d["filter"]) for d in selected],
+                         [(6377, "u"), (4192, "g"), (4192, "i"), (4192, "z")])
+        self.assertEqual(index.select(["field=400..500"]), [])
+        self.assertEqual(len(dataids.DataIdIndex(rows=[(1, "g", 1, 2)]).select(["filter=g"])), 1)
+
+    def testBadPattern(self):
+        """Test that invalid patterns are usage errors of the script, not tracebacks"""
+        with self.assertRaises(ValueError):
+            dataids.parsePattern("run=4192 color=g")
+        with self.assertRaises(ValueError):
+            dataids.parsePattern("run")
+        result = subprocess.run([sys.executable, os.path.join(package_root, "bin.src", "dataids.py"),
+                                 self.input, "--id", "run=4192 color=g"],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("Invalid dataId pattern", result.stderr)
+        self.assertNotIn("Traceback", result.stderr)
+
+    def testParentLink(self):
+        """Test finding the input repository through _parent links"""
+        staged = os.path.join(self.tmpDir, "staged-input")
+        output = os.path.join(self.tmpDir, "output")
+        os.makedirs(staged)
+        os.makedirs(output)
+        os.symlink(os.path.relpath(self.input, staged), os.path.join(staged, "_parent"))
+        os.symlink(staged, os.path.join(output, "_parent"))
+        self.assertEqual(os.path.realpath(dataids.findInputRepo(output)), os.path.realpath(self.input))
+        self.assertEqual(dataids.findInputRepo(self.input), self.input)
+        self.assertIsNone(dataids.findInputRepo(self.tmpDir))
+
+    @unittest.skipUnless(yaml, "PyYAML is needed to read repositoryCfg.yaml")
+    def testRepositoryCfg(self):
+        """Test finding the input repository through the parents of repositoryCfg.yaml"""
+        # parents listed as paths, or as their own (tagged) configs
+        parents = ["[%s]" % self.input,
+                   "\n- !RepositoryCfg_v1\n  _mapper: null\n  _parents: []\n  _root: ../input"]
+        for i, parent in enumerate(parents):
+            output = os.path.join(self.tmpDir, "output%d" % i)
+            os.makedirs(output)
+            with open(os.path.join(output, "repositoryCfg.yaml"), "w") as f:
+                f.write("!RepositoryCfg_v1\n_mapper: !!python/name:lsst.obs.sdss.sdssMapper.SdssMapper ''\n"
+                        "_mapperArgs: {}\n_parents: %s\n_policy: null\n_root: null\n" % parent)
+            self.assertEqual(dataids.findInputRepo(output), os.path.realpath(self.input))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -20,6 +20,9 @@
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 
+import subprocess
+import sys
+import time
 import unittest
 import os
 
@@ -30,6 +33,14 @@ package_root = getPackageDir('lsst_dm_stack_demo')
 
 executable_dir = os.path.join(package_root, 'bin')
 
+# Wall clock budget in seconds for running each post-processing script with
+# --help, which must not wait for the stack to load.
+STARTUP_BUDGETS = {'compare.py': 1.0, 'check_astrometry.py': 1.0}
+
+# Modules which must not be imported when the post-processing scripts start.
+DEFERRED_MODULES = ('lsst.daf.persistence', 'lsst.pipe.base', 'lsst.afw', 'lsst.geom', 'matplotlib',
+                    'scipy', 'pyarrow', 'multiprocessing')
+
 
 class DemoTestCase(lsst.utils.tests.ExecutablesTestCase):
     """Test the demo scrpts for executablility."""
@@ -47,6 +58,35 @@ class DemoTestCase(lsst.utils.tests.ExecutablesTestCase):
                               root_dir=executable_dir,
                               args=['output_small'],
                               msg="Check astrometry failed")
+        self.assertExecutable("demo.py",
+                              root_dir=executable_dir,
+                              args=['--small', 'check-astrometry'],
+                              msg="Single-process check astrometry failed")
+
+
+class StartupTestCase(lsst.utils.tests.TestCase):
+    """Test the startup time of the post-processing scripts."""
+    def testDeferredImports(self):
+        """Test that the stack is only imported when needed"""
+        code = "import sys; sys.path.insert(0, %r); import %s; print(' '.join(sys.modules))"
+        for module in ('compare', 'check_astrometry'):
+            loaded = subprocess.check_output([sys.executable, '-c', code % (executable_dir, module)],
+                                             universal_newlines=True).split()
+            for name in DEFERRED_MODULES:
+                imported = [m for m in loaded if m == name or m.startswith(name + '.')]
+                self.assertEqual(imported, [], "%s imports %s at startup" % (module, name))
+
+    def testStartupTime(self):
+        """Test the startup time of the scripts against their budgets"""
+        with open(os.devnull, 'w') as devnull:
+            for script, budget in STARTUP_BUDGETS.items():
+                times = []
+                for i in range(3):
+                    start = time.time()
+                    subprocess.check_call([sys.executable, os.path.join(executable_dir, script), '--help'],
+                                          stdout=devnull)
+                    times.append(time.time() - start)
+                self.assertLess(min(times), budget, "%s --help took %.2f s" % (script, min(times)))
 
 
 if __name__ == "__main__":
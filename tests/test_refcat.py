@@ -0,0 +1,171 @@
+#
+# LSST Data Management System
+# Copyright 2012-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+import contextlib
+import importlib.util
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+# refcat.py only needs NumPy, and astropy to build the shard index, so it is
+# tested without the stack.
+package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(package_root, 'bin.src'))
+
+import refcat  # noqa: E402
+
+try:
+    import astropy  # noqa: F401
+except ImportError:
+    astropy = None
+
+REF_CAT_DIR = os.path.join(package_root, 'input', 'ref_cats', 'sdss_demo_ref_cat')
+STARS = os.path.join(package_root, 'ref_cat', 'stars.fits')
+
+# ingest-refcat.py is not a valid module name.
+spec = importlib.util.spec_from_file_location("ingest_refcat",
+                                              os.path.join(package_root, 'bin.src', 'ingest-refcat.py'))
+ingest_refcat = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(ingest_refcat)
+
+COLUMNS = dict(id="sdssid", ra="ra", dec="dec", extra=["starnotgal"],
+               mags=[(f, f, f + "_err") for f in "ugriz"])
+
+# HTM depth of the shards of the demo reference catalog.
+DEPTH = 7
+
+
+@unittest.skipUnless(astropy, "astropy is needed to index the reference catalog")
+class ShardIndexTestCase(unittest.TestCase):
+    """Test the HTM ids and cone searches of refcat.py on the demo reference catalog."""
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        # keep the index out of the package
+        self.index = refcat.ShardIndex(REF_CAT_DIR, os.path.join(self.tmpDir, refcat.INDEX_FILE))
+        tables = [self.index.readShard(shardId) for shardId in sorted(self.index.shards)]
+        self.shardIds = np.concatenate([np.full(len(t), shardId) for shardId, t in
+                                        zip(sorted(self.index.shards), tables)])
+        self.rows = np.concatenate([t.astype(t.dtype.newbyteorder("=")) for t in tables])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def bruteForce(self, ra, dec, radius):
+        """Return the ids of the rows within a cone, and the ids of their shards."""
+        center = refcat.unitVector(np.deg2rad(ra), np.deg2rad(dec))
+        vectors = refcat.unitVector(self.rows["coord_ra"], self.rows["coord_dec"])
+        inside = vectors.dot(center) >= np.cos(np.deg2rad(radius))
+        return np.sort(self.rows["id"][inside]), set(self.shardIds[inside].tolist())
+
+    def testIndex(self):
+        """Test that the index lists every shard with its rows, and that it is saved where asked"""
+        self.assertTrue(os.path.exists(os.path.join(self.tmpDir, refcat.INDEX_FILE)))
+        self.assertGreater(len(self.index.shards), 1)
+        self.assertEqual(sum(entry["rows"] for entry in self.index.shards.values()), len(self.rows))
+        self.assertFalse(refcat.ShardIndex(REF_CAT_DIR, self.index.indexFile).update())
+
+    def testHtmIndex(self):
+        """Test that the HTM id of every row is the id of its shard"""
+        ids = refcat.htmIndex(refcat.unitVector(self.rows["coord_ra"], self.rows["coord_dec"]), DEPTH)
+        np.testing.assert_array_equal(ids, self.shardIds)
+
+    def testHtmRoots(self):
+        """Test the ids of the root trixels and of their first children"""
+        vectors = refcat.unitVector(np.deg2rad([45., 135., 225., 315., 45., 135., 225., 315.]),
+                                    np.deg2rad([-45.]*4 + [45.]*4))
+        np.testing.assert_array_equal(refcat.htmIndex(vectors, 0), [8, 9, 10, 11, 15, 14, 13, 12])
+        np.testing.assert_array_equal(refcat.htmIndex(vectors, 1) // 4, refcat.htmIndex(vectors, 0))
+
+    def testConeSearch(self):
+        """Test cone searches against a scan of all rows"""
+        rng = np.random.RandomState(1)
+        centers = [(self.rows["coord_ra"][i], self.rows["coord_dec"][i])
+                   for i in rng.choice(len(self.rows), 5, replace=False)]
+        for raRad, decRad in centers:
+            ra, dec = np.rad2deg(raRad), np.rad2deg(decRad)
+            for radius in (0.01, 0.1, 0.5, 2.):
+                ids, shardIds = self.bruteForce(ra, dec, radius)
+                rows = self.index.coneSearch(ra, dec, radius)
+                np.testing.assert_array_equal(np.sort(rows["id"]), ids)
+                self.assertTrue(all(rows.dtype[name].isnative for name in rows.dtype.names))
+                self.assertTrue(shardIds <= set(self.index.overlapping(ra, dec, radius)))
+
+    def testEmptyCone(self):
+        """Test a cone away from the catalog"""
+        self.assertEqual(self.index.overlapping(180., 60., 1.), [])
+        rows = self.index.coneSearch(180., 60., 1.)
+        self.assertEqual(len(rows), 0)
+        self.assertIn("coord_ra", rows.dtype.names)
+
+
+@unittest.skipUnless(astropy, "astropy is needed to read and write the catalogs")
+class IngestTestCase(unittest.TestCase):
+    """Test ingest-refcat.py against the demo reference catalog it was ingested into."""
+    def setUp(self):
+        from astropy.io import fits
+        self.tmpDir = tempfile.mkdtemp()
+        with fits.open(STARS) as hdus:
+            self.stars = np.array(hdus[1].data)
+        self.index = refcat.ShardIndex(REF_CAT_DIR, os.path.join(self.tmpDir, refcat.INDEX_FILE))
+        tables = [self.index.readShard(shardId) for shardId in sorted(self.index.shards)]
+        self.rows = np.concatenate([t.astype(t.dtype.newbyteorder("=")) for t in tables])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testConvertChunk(self):
+        """Test that converted rows match the rows of the same ids in the demo catalog"""
+        records = ingest_refcat.convertChunk(self.stars, self.rows.dtype, COLUMNS)
+        records = records[np.argsort(records["id"])]
+        rows = self.rows[np.argsort(self.rows["id"])]
+        np.testing.assert_array_equal(records["id"], rows["id"])
+        np.testing.assert_array_equal(records["starnotgal"], rows["starnotgal"])
+        fluxes = [f + suffix for f in "ugriz" for suffix in ("_flux", "_fluxErr")]
+        for name in ["coord_ra", "coord_dec"] + fluxes:
+            np.testing.assert_allclose(records[name], rows[name], rtol=1e-14, err_msg=name)
+
+    def testIngestDepth(self):
+        """Test that the shards and config of an ingested catalog have the depth asked for"""
+        outputDir = os.path.join(self.tmpDir, "ref_cat")
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            self.assertTrue(ingest_refcat.main(STARS, outputDir, COLUMNS, template=REF_CAT_DIR, depth=5,
+                                               chunkSize=10000))
+        with open(os.path.join(outputDir, "config.py")) as f:
+            config = f.read()
+        self.assertIn("config.indexer['HTM'].depth=5\n", config)
+        self.assertNotIn("config.indexer['HTM'].depth=7", config)
+        index = refcat.ShardIndex(outputDir)
+        self.assertEqual(sum(entry["rows"] for entry in index.shards.values()), len(self.stars))
+        for shardId in index.shards:
+            data = index.readShard(shardId)
+            ids = refcat.htmIndex(refcat.unitVector(data["coord_ra"], data["coord_dec"]), 5)
+            self.assertTrue((ids == shardId).all())
+
+
+if __name__ == "__main__":
+    unittest.main()